@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Index of the alerts, stored in SQLite next to the alert folders.
+# Written by the watchdog and read by the web server.
+
+import os
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+Alert = namedtuple('Alert', 'time event folder_name poster_path video_path clip_path')
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class AlertStore:
+    def __init__(self, path, readOnly=False):
+        """readOnly is for the web server, the watchdog manages the schema."""
+        self.path = path
+        self.readOnly = readOnly
+        self.lock = threading.Lock()
+        if readOnly:
+            self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=10, check_same_thread=False)
+            return
+        self.connection = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.lock, self.connection:
+            # WAL lets the web server read while the watchdog writes.
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS alerts (
+                                           time TEXT NOT NULL,
+                                           event TEXT NOT NULL,
+                                           folder_name TEXT NOT NULL UNIQUE,
+                                           poster_path TEXT,
+                                           video_path TEXT)''')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS alerts_time ON alerts (time)')
+            # Added after the first version.
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(alerts)')]
+            if 'clip_path' not in columns:
+                self.connection.execute('ALTER TABLE alerts ADD COLUMN clip_path TEXT')
+
+    def add(self, time, event, folderName, posterPath, videoPath):
+        """The paths are relative to the alerts folder."""
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO alerts (time, event, folder_name, poster_path, video_path) VALUES (?, ?, ?, ?, ?)',
+                                    (time.strftime(TIME_FORMAT), event, folderName, posterPath, videoPath))
+
+    def setClipPath(self, folderName, clipPath):
+        """Full resolution clip of the alert, relative to the alerts folder."""
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE alerts SET clip_path = ? WHERE folder_name = ?', (clipPath, folderName))
+
+    def remove(self, folderName):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM alerts WHERE folder_name = ?', (folderName,))
+
+    def query(self, start, end):
+        """Alerts with start <= time < end, most recent first."""
+        with self.lock:
+            clipPath = 'clip_path'
+            if self.readOnly:
+                # Not migrated yet by an older watchdog.
+                columns = [row[1] for row in self.connection.execute('PRAGMA table_info(alerts)')]
+                if 'clip_path' not in columns:
+                    clipPath = 'NULL'
+            rows = self.connection.execute(f'SELECT time, event, folder_name, poster_path, video_path, {clipPath} FROM alerts WHERE time >= ? AND time < ? ORDER BY time DESC',
+                                           (start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT))).fetchall()
+        return [Alert(datetime.strptime(r[0], TIME_FORMAT), *r[1:]) for r in rows]
+
+    def version(self):
+        """Changes whenever the store gets modified, cheap to compute."""
+        version = []
+        for path in [self.path, self.path + '-wal']:
+            try:
+                st = os.stat(path)
+                version.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def importLegacyDb(self, legacyPath, alertsDir):
+        """Import the alerts of the text file used by older versions."""
+        with open(legacyPath, 'r') as f:
+            lines = f.readlines()
+        for l in lines:
+            m = re.match(r'(\d\d\d\d-\d\d-\d\d_\d\d_\d\d_\d\d) (\S+) \{"folder_name": "(.*)"\}$', l.rstrip())
+            if not m:
+                continue
+            time = datetime.strptime(m.group(1), '%Y-%m-%d_%H_%M_%S')
+            folderName = m.group(3)
+            posterPath = f'{folderName}/{folderName}_annotated.jpg'
+            if not os.path.exists(os.path.join(alertsDir, posterPath)):
+                posterPath = None
+            self.add(time, m.group(2), folderName, posterPath, f'{folderName}/before_and_after.mp4')
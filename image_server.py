@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 from datetime import datetime
+from collections import deque
+import os
 import sys
+import threading
 import cv2 as cv
 import numpy as np
 import zmq
@@ -10,24 +13,67 @@ import time
 import logging
 import argparse
 
+import metrics
+import wire_protocol
+
 debug = False
 
-minDeltaTime = 1.0
-maxWidthToSend = 640
-jpegQuality = 90
+logger = logging.getLogger('image_server')
+
+def computeSubsampledSize(width, height, maxWidth):
+    scaleFactor = width / float(maxWidth)
+    if (scaleFactor > 1.5):
+        return (int(round(width / scaleFactor)), int(round(height / scaleFactor)))
+    return None
+
+def activeFps(args):
+    return max(args.fps, args.active_fps or 0)
+
+def activeMaxWidth(args):
+    return max(args.max_width, args.active_max_width or 0)
 
 class FFMpegCaptureSource:
     def __init__(self, args):
-        self.width = args.width
-        self.height = args.height
+        self.source_width = args.width
+        self.source_height = args.height
         self.video_url = args.source
+        # ffmpeg always outputs the active frame rate and resolution, when
+        # idle the extra frames get skipped and downscaled in Python.
+        self.fps = activeFps(args)
+        self.keyframes_only = args.keyframes_only
+        self.hwaccel = args.hwaccel
+        # The frame rate reduction and the downscaling happen in the ffmpeg
+        # graph, so Python only reads the frames that can get sent. With
+        # only the keyframes, the fps filter would duplicate them to reach
+        # the rate, so they get decimated by time in Python instead.
+        self.limits_frame_rate = not self.keyframes_only
+        self.subsampled_size = computeSubsampledSize(args.width, args.height, activeMaxWidth(args))
+        self.width, self.height = self.subsampled_size or (args.width, args.height)
+        # Every frame gets read into the same buffer.
+        self.frame_buffer = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.frame_view = memoryview(self.frame_buffer).cast('B')
     
     def start_capture(self):
         import ffmpeg
+        input_args = {}
+        if self.keyframes_only:
+            # Only decode the keyframes, typically one every 1-2 seconds.
+            input_args['skip_frame'] = 'nokey'
+        if self.hwaccel:
+            input_args['hwaccel'] = self.hwaccel
+        stream = ffmpeg.input(self.video_url, **input_args)
+        if self.fps and self.limits_frame_rate:
+            stream = stream.filter('fps', fps=self.fps)
+        if self.subsampled_size:
+            stream = stream.filter('scale', self.width, self.height)
+        output_args = {}
+        if not self.limits_frame_rate:
+            # Otherwise the rawvideo muxer duplicates the frames to keep
+            # the constant input rate.
+            output_args['vsync'] = 'passthrough'
         self.ffmpeg_process = (
-            ffmpeg
-            .input(self.video_url)
-            .output('pipe:', format='rawvideo', pix_fmt='bgr24')
+            stream
+            .output('pipe:', format='rawvideo', pix_fmt='bgr24', **output_args)
             .run_async(pipe_stdout=True)
         )
 
@@ -35,21 +81,21 @@ class FFMpegCaptureSource:
         self.ffmpeg_process.wait()
 
     def capture_next_frame(self):
-        in_bytes = self.ffmpeg_process.stdout.read(self.width * self.height * 3)
-        if not in_bytes:
-            print ("Cannot read images anymore")
-            return None
-        in_frame = (
-            np
-            .frombuffer(in_bytes, np.uint8)
-            .reshape([self.height, self.width, 3])
-        )
-        return in_frame
+        # The returned frame is only valid until the next call.
+        num_read = 0
+        while num_read < len(self.frame_view):
+            n = self.ffmpeg_process.stdout.readinto(self.frame_view[num_read:])
+            if not n:
+                logger.warning("Cannot read images anymore")
+                return None
+            num_read += n
+        return self.frame_buffer
 
 class PiCameraCaptureSource:
     def __init__(self, args):
         self.width = args.width
         self.height = args.height
+        self.limits_frame_rate = False
 
         import picamera, picamera.array
         self.camera = picamera.PiCamera(resolution=(self.width, self.height))
@@ -71,34 +117,227 @@ class PiCameraCaptureSource:
             self.camera.annotate_text = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             self.camera.capture(self.bgr_buffer, 'bgr')
         except Exception as e:
-            print ("Failed to capture image: " + str(e))
+            logger.error("Failed to capture image: %s", e)
             return None
         return self.bgr_buffer
 
-def runVideoCapture(args, capture_source, s):    
+class FrameSender:
+    def __init__(self, socket, args):
+        self.socket = socket
+        self.camera_id = args.camera_id
+        self.legacy_pickle_protocol = args.legacy_pickle_protocol
+        # Lets the watchdog measure the dropped frames.
+        self.sequence = 0
+
+    def send(self, jpeg, width, height, timestamp):
+        if self.legacy_pickle_protocol:
+            self.socket.send_pyobj(jpeg)
+            return
+        header = wire_protocol.FrameHeader(camera_id=self.camera_id, sequence=self.sequence, timestamp=timestamp,
+                                           width=width, height=height, encoding=wire_protocol.ENCODING_JPEG)
+        wire_protocol.sendFrame(self.socket, header, jpeg)
+        self.sequence += 1
+
+class MotionPrefilter:
+    """Cheap frame differencing on a tiny grayscale thumbnail.
+
+    Runs on every captured frame to switch to the active mode without
+    waiting for the watchdog.
+    """
+    def __init__(self, width=64, threshold=25, min_changed_fraction=0.01):
+        self.width = width
+        self.threshold = threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.previous = None
+
+    def update(self, frame):
+        """Returns True if the frame changed significantly since the previous one."""
+        height, width = frame.shape[0:2]
+        thumbnailSize = (self.width, max(1, int(round(height * self.width / float(width)))))
+        thumbnail = cv.cvtColor(cv.resize(frame, thumbnailSize, interpolation=cv.INTER_AREA), cv.COLOR_BGR2GRAY)
+        previous, self.previous = self.previous, thumbnail
+        if previous is None:
+            return False
+        numChanged = np.count_nonzero(cv.absdiff(thumbnail, previous) > self.threshold)
+        return numChanged >= self.min_changed_fraction * thumbnail.size
+
+class RateController:
+    """Switches between the idle and the active frame rate and resolution.
+
+    The watchdog asks for the active mode on the control socket while it
+    sees motion, each request lasting a few seconds. The prefilter can
+    also trigger it.
+    """
+    def __init__(self, args, control_socket):
+        self.control_socket = control_socket
+        self.active_seconds = args.active_seconds
+        self.prefilter = MotionPrefilter() if args.motion_prefilter else None
+        self.active_until = 0
+        metrics.registerCollector(lambda: [('active', 'gauge', {}, int(self.isActive(time.time())))])
+
+    def isActive(self, now):
+        return now < self.active_until
+
+    def setActive(self, now, seconds, reason):
+        if not self.isActive(now):
+            logger.info("Switching to the active mode (%s)", reason)
+            metrics.counter('active_mode_switches_total', reason=reason).inc()
+        self.active_until = max(self.active_until, now + seconds)
+
+    def update(self, frame, now):
+        while self.control_socket and self.control_socket.poll(0):
+            try:
+                request = wire_protocol.receiveControlRequest(self.control_socket)
+            except wire_protocol.ProtocolError as e:
+                logger.warning("Ignoring invalid control request: %s", e)
+                continue
+            if request.command == wire_protocol.COMMAND_ACTIVE:
+                # Bounded in case a client never asks again.
+                self.setActive(now, min(request.seconds, 300), 'watchdog')
+        if self.prefilter:
+            with metrics.timed('prefilter'):
+                changed = self.prefilter.update(frame)
+            if changed:
+                self.setActive(now, self.active_seconds, 'prefilter')
+        return self.isActive(now)
+
+class ClipBuffer:
+    """Last seconds of the original camera stream, kept in memory.
+
+    A second ffmpeg process copies the encoded packets into MPEG-TS without
+    decoding them, so keeping the full resolution stream is cheap.
+    """
+    # Whole MPEG-TS packets of 188 bytes, so the clips can start at any chunk.
+    CHUNK_SIZE = 188 * 64
+
+    def __init__(self, video_url, seconds):
+        self.video_url = video_url
+        self.seconds = seconds
+        self.chunks = deque() # (arrival time, bytes)
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        metrics.registerCollector(lambda: [('clip_buffer_bytes', 'gauge', {}, self.num_bytes)])
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        import ffmpeg
+        while True:
+            input_args = {}
+            if os.path.isfile(self.video_url):
+                # Read the files at their native rate, like a camera.
+                input_args['re'] = None
+            process = (
+                ffmpeg
+                .input(self.video_url, **input_args)
+                .output('pipe:', format='mpegts', c='copy', an=None)
+                .global_args('-hide_banner', '-loglevel', 'error')
+                .run_async(pipe_stdout=True)
+            )
+            while True:
+                chunk = process.stdout.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.append(time.time(), chunk)
+            process.wait()
+            logger.warning("The clip buffer stream stopped, restarting it")
+            time.sleep(1)
+
+    def append(self, now, chunk):
+        with self.lock:
+            self.chunks.append((now, chunk))
+            self.num_bytes += len(chunk)
+            while self.chunks[0][0] < now - self.seconds:
+                self.num_bytes -= len(self.chunks.popleft()[1])
+
+    def extract(self, start, end):
+        with self.lock:
+            return b''.join(chunk for t, chunk in self.chunks if start <= t <= end)
+
+class ClipServer:
+    """Sends the clips requested by the watchdog on a ROUTER socket.
+
+    A clip is sent once its part after the request got recorded, from a
+    separate thread so the capture is never delayed.
+    """
+    def __init__(self, socket, clip_buffer):
+        self.socket = socket
+        self.clip_buffer = clip_buffer
+        self.pending = [] # (identity, request_id, start, end)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            if self.socket.poll(100):
+                self.receiveRequest()
+            now = time.time()
+            ready = [p for p in self.pending if p[3] <= now]
+            self.pending = [p for p in self.pending if p[3] > now]
+            for identity, request_id, start, end in ready:
+                with metrics.timed('clip_extract'):
+                    payload = self.clip_buffer.extract(start, end)
+                header = wire_protocol.ClipHeader(request_id=request_id, start_time=start, end_time=end,
+                                                  encoding=wire_protocol.ENCODING_MPEGTS)
+                wire_protocol.sendClip(self.socket, identity, header, payload)
+                metrics.counter('clips_sent_total').inc()
+                logger.info("Sent a clip of %.1fs (%d bytes)", end - start, len(payload))
+
+    def receiveRequest(self):
+        try:
+            identity, request = wire_protocol.receiveClipRequest(self.socket)
+        except wire_protocol.ProtocolError as e:
+            logger.warning("Ignoring invalid clip request: %s", e)
+            return
+        now = time.time()
+        # The start of the clip must still be in the buffer when it gets sent.
+        seconds_after = min(request.seconds_after, self.clip_buffer.seconds)
+        seconds_before = min(request.seconds_before, self.clip_buffer.seconds - seconds_after)
+        if seconds_before < request.seconds_before:
+            logger.warning("The clip buffer is too short for %.1fs before the alert, increase --clip-buffer-seconds", request.seconds_before)
+        self.pending.append((identity, request.request_id, now - seconds_before, now + seconds_after))
+
+def runVideoCapture(args, capture_source, sender, rate_controller):
     capture_source.start_capture()
-    scaleFactor = capture_source.width / float(maxWidthToSend)
-    subsampledSize = None
-    if (scaleFactor > 1.5):
-        subsampledSize = (int(round(capture_source.width / scaleFactor)), int(round(capture_source.height / scaleFactor)))
+    # When ffmpeg limits the frame rate it outputs the active one, then
+    # only one frame out of idleFrameStep gets sent when idle.
+    idleFrameStep = max(1, int(round(activeFps(args) / args.fps)))
+    # Preallocated resize destination for each output size.
+    resized_frames = {}
+    encode_param = [int(cv.IMWRITE_JPEG_QUALITY), args.jpeg_quality]
 
     lastImageSentTimestamp = None
+    numCaptured = 0
     while True:
-        in_frame = capture_source.capture_next_frame()
+        with metrics.timed('capture'):
+            in_frame = capture_source.capture_next_frame()
         if in_frame is None:
-            print ("Cannot read images anymore")
+            logger.warning("Cannot read images anymore")
             break
         
-        now = time.time()        
-        if not lastImageSentTimestamp or (now-lastImageSentTimestamp) >= minDeltaTime:
+        metrics.counter('frames_captured_total').inc()
+        numCaptured += 1
+        now = time.time()
+        active = rate_controller.update(in_frame, now)
+        if capture_source.limits_frame_rate:
+            shouldSend = active or (numCaptured - 1) % idleFrameStep == 0
+        else:
+            minDeltaTime = 1.0 / (activeFps(args) if active else args.fps)
+            shouldSend = not lastImageSentTimestamp or (now-lastImageSentTimestamp) >= minDeltaTime
+        if shouldSend:
             final_frame = in_frame
+            maxWidth = activeMaxWidth(args) if active else args.max_width
+            subsampledSize = computeSubsampledSize(in_frame.shape[1], in_frame.shape[0], maxWidth)
             if subsampledSize:
-                final_frame = cv.resize(in_frame, subsampledSize)
-            encode_param = [int(cv.IMWRITE_JPEG_QUALITY), jpegQuality]
-            data = cv.imencode('.jpg', final_frame)[1]
-            s.send_pyobj(data)
+                if subsampledSize not in resized_frames:
+                    resized_frames[subsampledSize] = np.empty((subsampledSize[1], subsampledSize[0], 3), dtype=np.uint8)
+                with metrics.timed('resize'):
+                    final_frame = cv.resize(in_frame, subsampledSize, dst=resized_frames[subsampledSize])
+            with metrics.timed('encode'):
+                data = cv.imencode('.jpg', final_frame, encode_param)[1]
+            with metrics.timed('send'):
+                sender.send(data, final_frame.shape[1], final_frame.shape[0], now)
+            metrics.counter('frames_sent_total').inc()
             lastImageSentTimestamp = now
-            print (f"Image sent with size {capture_source.width} x {capture_source.height}.")
+            logger.debug("Image sent with size %d x %d.", final_frame.shape[1], final_frame.shape[0])
             if debug:
                 cv.imshow ('image', in_frame)
                 cv.waitKey (1)
@@ -110,14 +349,34 @@ def parseCommandLine():
     parser.add_argument('source', help='picamera, RTSP URL or video file')
     parser.add_argument('width', type=int, help='Source image width')
     parser.add_argument('height', type=int, help='Source image height')
+    parser.add_argument('--fps', help='Number of images sent per second', type=float, default=1.0)
+    parser.add_argument('--max-width', help='Images wider than that get downscaled before being sent', type=int, default=640)
+    parser.add_argument('--active-fps', help='Number of images sent per second in the active mode, while there is motion. Default is --fps', type=float)
+    parser.add_argument('--active-max-width', help='Maximum width of the images sent in the active mode. Default is --max-width', type=int)
+    parser.add_argument('--active-seconds', help='Duration of the active mode when triggered by the prefilter', type=float, default=10.0)
+    parser.add_argument('--motion-prefilter', help='Switch to the active mode when the image changes, without waiting for the watchdog', action='store_true')
+    parser.add_argument('--control-bind-url', help='ZMQ bind URL for the control requests of the watchdog, e.g. "tcp://*:4243"')
+    parser.add_argument('--clip-bind-url', help='ZMQ bind URL to send clips of the original stream to the watchdog, e.g. "tcp://*:4244". Not available with picamera')
+    parser.add_argument('--clip-buffer-seconds', help='Duration of the original stream kept in memory for the clips', type=float, default=60.0)
+    parser.add_argument('--jpeg-quality', help='Quality of the JPEG images sent, between 0 and 100', type=int, default=90)
+    parser.add_argument('--hwaccel', help='ffmpeg hardware acceleration method used to decode the stream, e.g. "auto" or "vaapi"')
+    parser.add_argument('--keyframes-only', help='Only decode the keyframes of the stream, much cheaper if the keyframe interval matches the requested fps', action='store_true')
     parser.add_argument('--password', help='Password to connect to the image server')    
     parser.add_argument('--debug', help='Enable debugging', action='store_true')
+    parser.add_argument('--camera-id', help='Identifier of the camera sent with each image', type=int, default=0)
+    parser.add_argument('--legacy-pickle-protocol', help='Send the images in the old pickle format, for older watchdogs', action='store_true')
     parser.add_argument('--bind-url', help='ZMQ bind URL. Default is "tcp://*:4242"', default='tcp://*:4242')
+    parser.add_argument('--metrics-port', help='Serve Prometheus metrics on http://0.0.0.0:PORT/metrics', type=int)
+    parser.add_argument('--log-level', help='Logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parseCommandLine()
     debug = args.debug
+    logging.basicConfig(level='DEBUG' if debug else args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    metrics.prefix = 'image_server'
+    if args.metrics_port:
+        metrics.startHttpServer(args.metrics_port)
 
     ctx = zmq.Context()
 
@@ -131,15 +390,36 @@ if __name__ == "__main__":
        s.plain_server = True
     s.bind(args.bind_url)
 
+    sender = FrameSender(s, args)
+
+    control_socket = None
+    if args.control_bind_url:
+        control_socket = ctx.socket(zmq.ROUTER)
+        if args.password:
+            control_socket.plain_server = True
+        control_socket.bind(args.control_bind_url)
+    rate_controller = RateController(args, control_socket)
+
     capture_source = None
     if args.source == 'picamera':
         capture_source = PiCameraCaptureSource(args)
     else:
         capture_source = FFMpegCaptureSource(args)
 
+    if args.clip_bind_url:
+        if args.source == 'picamera':
+            logger.warning("Clips are not supported with picamera, ignoring --clip-bind-url")
+        else:
+            clip_socket = ctx.socket(zmq.ROUTER)
+            if args.password:
+                clip_socket.plain_server = True
+            clip_socket.bind(args.clip_bind_url)
+            ClipServer(clip_socket, ClipBuffer(args.source, args.clip_buffer_seconds))
+
     # Retry to capture data every second, in case the
     # stream stopped.
     while True:
-        runVideoCapture(args, capture_source, s)
+        runVideoCapture(args, capture_source, sender, rate_controller)
+        metrics.counter('capture_restarts_total').inc()
         time.sleep (1)
     auth.stop()
\ No newline at end of file
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+# Process-wide metrics: duration histograms of the processing steps,
+# counters, and collectors called when the metrics get exported. They can
+# be served in the Prometheus text format with startHttpServer.
+
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, in seconds.
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# Prefix of all the exported metric names, e.g. "watchdog".
+prefix = 'tiny_watchdog'
+
+class Timing:
+    """Histogram of the durations of a processing step."""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bucket_counts = [0] * len(DURATION_BUCKETS)
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    self.bucket_counts[i] += 1
+                    break
+
+    def recordBatch(self, seconds, count):
+        """Record a batch of count operations that took seconds overall."""
+        for _ in range(count):
+            self.record(seconds / count)
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter() - start)
+
+class Counter:
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+timings = {}
+counters = {}
+# Functions returning a list of (name, type, labels, value), called on export.
+collectors = []
+registry_lock = threading.Lock()
+
+def timing(name):
+    with registry_lock:
+        if name not in timings:
+            timings[name] = Timing(name)
+        return timings[name]
+
+def timed(name):
+    """Context manager recording the duration of its block."""
+    return timing(name).time()
+
+def counter(name, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with registry_lock:
+        if key not in counters:
+            counters[key] = Counter(name, labels)
+        return counters[key]
+
+def registerCollector(fn):
+    with registry_lock:
+        collectors.append(fn)
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in sorted(labels.items())) + '}'
+
+def renderPrometheus():
+    lines = []
+    with registry_lock:
+        sortedTimings = sorted(timings.values(), key=lambda t: t.name)
+        sortedCounters = sorted(counters.values(), key=lambda c: (c.name, sorted(c.labels.items())))
+        currentCollectors = list(collectors)
+
+    name = f'{prefix}_step_duration_seconds'
+    lines.append(f'# TYPE {name} histogram')
+    for t in sortedTimings:
+        with t.lock:
+            cumulative = 0
+            for bound, n in zip(DURATION_BUCKETS, t.bucket_counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{formatLabels({"step": t.name, "le": bound})} {cumulative}')
+            lines.append(f'{name}_bucket{formatLabels({"step": t.name, "le": "+Inf"})} {t.count}')
+            lines.append(f'{name}_sum{formatLabels({"step": t.name})} {t.total}')
+            lines.append(f'{name}_count{formatLabels({"step": t.name})} {t.count}')
+
+    # All the samples of a metric have to be in a single group, e.g. the
+    # ones of all the cameras, each collector only gives its own.
+    groups = {} # full name -> (kind, sample lines)
+    def addSample(name, kind, labels, value):
+        fullName = f'{prefix}_{name}'
+        if fullName not in groups:
+            groups[fullName] = (kind, [])
+        groups[fullName][1].append(f'{fullName}{formatLabels(labels)} {value}')
+
+    for c in sortedCounters:
+        addSample(c.name, 'counter', c.labels, c.value)
+    for collector in currentCollectors:
+        for name, kind, labels, value in collector():
+            if value is not None:
+                addSample(name, kind, labels, value)
+    for fullName, (kind, samples) in groups.items():
+        lines.append(f'# TYPE {fullName} {kind}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip('/') != '/metrics':
+            self.send_error(404)
+            return
+        body = renderPrometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scraped every few seconds, too verbose for the default logging.
+        pass
+
+def startHttpServer(port, host='0.0.0.0'):
+    """Serve the metrics on http://host:port/metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
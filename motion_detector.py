@@ -2,6 +2,7 @@
 
 import sys
 import time
+import logging
 from datetime import datetime, timedelta
 from collections import namedtuple
 from enum import Enum
@@ -11,62 +12,198 @@ import numpy as np
 
 debug = False
 
+logger = logging.getLogger('motion_detector')
+
 class Event(Enum):
     NONE = 0
     MOTION_DETECTED = 1
 
-Results = namedtuple('Results', 'event annotated_image')
-no_event = Results(event=Event.NONE, annotated_image=None)
+class Results(namedtuple('Results', 'event contours bounding_boxes')):
+    """Detected event, with the moving regions in full image coordinates."""
+    def annotate(self, image):
+        """Returns a copy of the image with the moving regions drawn on it."""
+        return cv.drawContours(image.copy(), self.contours, -1, (255,0,0), 3)
+
+no_event = Results(event=Event.NONE, contours=[], bounding_boxes=[])
 
 class Options:
     def __init__(self):
         self.num_images_to_initialize = 120
         self.min_seconds_between_detections = 120
+        # Width of the grayscale image given to the background subtractor,
+        # 0 to use the full resolution.
+        self.detection_width = 320
+        # Minimum area of a moving region, as a fraction of the image area.
+        self.min_area_fraction = 0.0013
+        # (x0, y0, x1, y1) rectangles as fractions of the image size. If
+        # there are regions of interest, only these get processed.
+        self.regions_of_interest = []
+        self.excluded_regions = []
+        # Background subtraction method, see `backends`.
+        self.backend = 'mog'
+        # Gray level difference considered as motion by the framediff backend.
+        self.frame_difference_threshold = 25
+
+# Background subtraction backends. Each factory takes the Options and
+# returns an object with an apply(gray_image) method returning the
+# foreground mask.
+backends = {}
+
+def registerBackend(name):
+    def register(factory):
+        backends[name] = factory
+        return factory
+    return register
+
+@registerBackend('mog')
+def createMOG(options):
+    return cv.bgsegm.createBackgroundSubtractorMOG(history=options.num_images_to_initialize, nmixtures=5)
+
+@registerBackend('mog2')
+def createMOG2(options):
+    return cv.createBackgroundSubtractorMOG2(history=options.num_images_to_initialize, detectShadows=False)
+
+@registerBackend('cnt')
+def createCNT(options):
+    return cv.bgsegm.createBackgroundSubtractorCNT(minPixelStability=15, maxPixelStability=15*60)
+
+class FrameDifferencing:
+    """Difference with a running average of the previous images.
+
+    Pure NumPy, does not need opencv-contrib.
+    """
+    def __init__(self, options, learning_rate=0.05):
+        self.threshold = options.frame_difference_threshold
+        self.learning_rate = learning_rate
+        self.background = None
+
+    def apply(self, gray):
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray.astype(np.float32)
+        diff = np.abs(gray - self.background)
+        self.background += self.learning_rate * (gray - self.background)
+        return (diff > self.threshold).astype(np.uint8) * 255
+
+@registerBackend('framediff')
+def createFrameDifferencing(options):
+    return FrameDifferencing(options)
+
+def createBackend(options):
+    if options.backend not in backends:
+        raise ValueError(f"Unknown detector backend {options.backend}, available ones: {', '.join(sorted(backends))}")
+    try:
+        return backends[options.backend](options)
+    except AttributeError:
+        # cv.bgsegm is missing.
+        raise ValueError(f"The {options.backend} detector backend requires opencv-contrib-python")
+
+class DetectionGeometry:
+    """Where and at which scale the detection runs for a given image size."""
+    def __init__(self, options, width, height):
+        self.image_size = (width, height)
+        regions = options.regions_of_interest or [(0.0, 0.0, 1.0, 1.0)]
+        def toPixels(region):
+            x0, y0, x1, y1 = region
+            return (int(x0*width), int(y0*height), int(round(x1*width)), int(round(y1*height)))
+        rois = [toPixels(r) for r in regions]
+        excluded = [toPixels(r) for r in options.excluded_regions]
+        # Only the bounding box of the regions of interest gets processed.
+        self.x0 = min(r[0] for r in rois)
+        self.y0 = min(r[1] for r in rois)
+        self.x1 = max(r[2] for r in rois)
+        self.y1 = max(r[3] for r in rois)
+        self.scale = 1.0
+        if options.detection_width and options.detection_width < width:
+            self.scale = options.detection_width / float(width)
+        self.detection_size = (max(1, int(round((self.x1-self.x0)*self.scale))),
+                               max(1, int(round((self.y1-self.y0)*self.scale))))
+        self.min_contour_area = options.min_area_fraction * width * height * self.scale * self.scale
+
+        self.mask = None
+        if options.regions_of_interest or options.excluded_regions:
+            self.mask = np.zeros((self.detection_size[1], self.detection_size[0]), dtype=np.uint8)
+            for r in rois:
+                cv.rectangle(self.mask, self.toDetection(r[0], r[1]), self.toDetection(r[2], r[3]), 255, -1)
+            for r in excluded:
+                cv.rectangle(self.mask, self.toDetection(r[0], r[1]), self.toDetection(r[2], r[3]), 0, -1)
+
+    def toDetection(self, x, y):
+        return (int(round((x-self.x0)*self.scale)), int(round((y-self.y0)*self.scale)))
+
+    def contourToImage(self, contour):
+        return (contour.astype(np.float32) / self.scale + (self.x0, self.y0)).astype(np.int32)
 
 class Detector:
     def __init__(self, options=Options()):
         self.options = options
-        self.fgbg = cv.bgsegm.createBackgroundSubtractorMOG(history=self.options.num_images_to_initialize, nmixtures=5)
-        # self.fgbg = cv.bgsegm.createBackgroundSubtractorGMG(initializationFrames=self.options.num_images_to_initialize)
-        # self.fgbg = cv.bgsegm.createBackgroundSubtractorCNT(minPixelStability=15, maxPixelStability=15*60)
+        self.fgbg = createBackend(self.options)
         self.kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE,(3,3))
         self.num_images_processed = 0
         self.last_detection_date = None
-
-    def processImage(self, image):
+        # Last time motion was seen, even if it did not trigger an event.
+        self.last_raw_motion_date = None
+        self.geometry = None
+
+    def prepareDetectionImage(self, image):
+        """Crop, downscale and convert to grayscale, then mask."""
+        g = self.geometry
+        cropped = image[g.y0:g.y1, g.x0:g.x1]
+        if g.scale < 1.0:
+            cropped = cv.resize(cropped, g.detection_size, interpolation=cv.INTER_AREA)
+        gray = cv.cvtColor(cropped, cv.COLOR_BGR2GRAY)
+        if g.mask is not None:
+            # Masked pixels stay constant, so they never look like motion.
+            cv.bitwise_and(gray, g.mask, dst=gray)
+        return gray
+
+    def processBatch(self, images, times=None):
+        """Process consecutive images of the same camera, in order."""
+        times = times or [None] * len(images)
+        return [self.processImage(image, now) for image, now in zip(images, times)]
+
+    def processImage(self, image, now=None):
+        # now can be given to process recorded images with their own clock.
+        now = now or datetime.now()
         self.num_images_processed += 1
-        fgmask = self.fgbg.apply(image)
+        height, width = image.shape[0:2]
+        if self.geometry is None or self.geometry.image_size != (width, height):
+            self.geometry = DetectionGeometry(self.options, width, height)
+
+        fgmask = self.fgbg.apply(self.prepareDetectionImage(image))
         fgmask = cv.morphologyEx(fgmask, cv.MORPH_OPEN, self.kernel)
+        if self.geometry.mask is not None:
+            cv.bitwise_and(fgmask, self.geometry.mask, dst=fgmask)
 
         contours, hierarchy = cv.findContours(fgmask, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
         large_contours = []
         for c in contours:
-            if cv.contourArea(c) > 20*20:
-                large_contours.append(c)
-
-        annotated_image = cv.drawContours(image, large_contours, -1, (255,0,0), 3)
+            if cv.contourArea(c) > self.geometry.min_contour_area:
+                large_contours.append(self.geometry.contourToImage(c))
 
         if debug:
             cv.imshow('mask', fgmask)
-            cv.imshow('annotated_detections', annotated_image)
+            cv.imshow('annotated_detections', cv.drawContours(image.copy(), large_contours, -1, (255,0,0), 3))
 
         if len(large_contours) == 0:
             return no_event
 
-        print (f"Raw motion detected ({len(contours)} contours), let's see if it triggers an event")
+        logger.debug("Raw motion detected (%d contours), let's see if it triggers an event", len(contours))
 
         # Let the detector enough time to initialize.
         if self.num_images_processed < self.options.num_images_to_initialize:
             return no_event
 
+        self.last_raw_motion_date = now
+
         # Already triggered an event less than a minute ago, don't do it again.
         if self.last_detection_date != None:
-            seconds_since_last_detection = (datetime.now()-self.last_detection_date).seconds
+            seconds_since_last_detection = (now-self.last_detection_date).total_seconds()
             if seconds_since_last_detection < self.options.min_seconds_between_detections:
                 return no_event
 
-        self.last_detection_date = datetime.now()
-        return Results(event=Event.MOTION_DETECTED, annotated_image=annotated_image)
+        self.last_detection_date = now
+        return Results(event=Event.MOTION_DETECTED, contours=large_contours,
+                       bounding_boxes=[cv.boundingRect(c) for c in large_contours])
 
 if __name__ == '__main__':
     detector = Detector()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('pipeline')
+
+# What to do when a stage queue is full.
+#  block: the producer waits, which pushes back on the receiver.
+#  drop-oldest: the oldest queued item is discarded to make room.
+#  drop-newest: the new item is discarded.
+DROP_POLICIES = ['block', 'drop-oldest', 'drop-newest']
+
+class PipelineStage:
+    """Bounded queue of items processed in order by a handler.
+
+    The items are processed one at a time, or as a list of all the queued
+    items if batch is True. The stage does not own a thread: it gets
+    scheduled on an executor that can be shared by several stages.
+    """
+    def __init__(self, name, handler, executor, maxSize, dropPolicy='block', maxItemsPerRun=16, batch=False):
+        assert dropPolicy in DROP_POLICIES
+        self.name = name
+        self.handler = handler
+        self.executor = executor
+        self.maxSize = maxSize
+        self.dropPolicy = dropPolicy
+        self.maxItemsPerRun = maxItemsPerRun
+        self.batch = batch
+        # (item, droppable)
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.scheduled = False
+        self.closed = False
+        self.numProcessed = 0
+        self.numDropped = 0
+
+    def put(self, item, droppable=True):
+        """Returns False if the item was dropped."""
+        with self.condition:
+            if self.closed:
+                return False
+            if droppable and len(self.items) >= self.maxSize:
+                if self.dropPolicy == 'drop-newest':
+                    self.numDropped += 1
+                    return False
+                elif self.dropPolicy == 'drop-oldest':
+                    # The non-droppable items stay queued.
+                    oldest = next((i for i, (_, d) in enumerate(self.items) if d), None)
+                    self.numDropped += 1
+                    if oldest is None:
+                        return False
+                    del self.items[oldest]
+                else:
+                    while len(self.items) >= self.maxSize and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return False
+            self.items.append((item, droppable))
+            if not self.scheduled:
+                self.scheduled = True
+                self.executor.submit(self.run)
+        return True
+
+    def run(self):
+        # Process a limited number of items before giving the worker back
+        # so that the stages sharing the executor all make progress.
+        numRemaining = self.maxItemsPerRun
+        while numRemaining > 0:
+            with self.condition:
+                if len(self.items) == 0:
+                    self.scheduled = False
+                    self.condition.notify_all()
+                    return
+                numItems = min(numRemaining, len(self.items)) if self.batch else 1
+                items = [self.items.popleft()[0] for _ in range(numItems)]
+                self.condition.notify_all()
+            try:
+                if self.batch:
+                    self.handler(items)
+                else:
+                    self.handler(items[0])
+            except Exception:
+                logger.exception("Exception in the %s stage", self.name)
+            self.numProcessed += numItems
+            numRemaining -= numItems
+        with self.condition:
+            self.executor.submit(self.run)
+
+    def close(self):
+        """Stop accepting new items and wake up the blocked producers."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def join(self):
+        """Wait until all the queued items got processed."""
+        with self.condition:
+            while self.scheduled:
+                self.condition.wait()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Replays a video file or a folder of JPEG images through the processing
+# path of the watchdog, headless and as fast as possible, with a simulated
+# clock. Reports the timings of each processing step to compare detector
+# settings and catch performance regressions.
+#
+# Example:
+#   ./replay.py scene1.mp4 --data-dir /tmp/replay --interval 60 --detector-backend cnt
+
+import argparse
+import glob
+import os
+import resource
+import shutil
+import sys
+import time
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+import numpy as np
+
+import metrics
+import watchdog
+
+def readJpegDirectory(path):
+    for f in sorted(glob.glob(os.path.join(path, '*.jpg'))):
+        yield np.fromfile(f, dtype=np.uint8)
+
+def readVideo(path, maxWidth, jpegQuality):
+    # Encode the frames like the image server would.
+    cap = cv.VideoCapture(path)
+    if not cap.isOpened():
+        raise IOError(f"Could not open {path}")
+    encode_param = [int(cv.IMWRITE_JPEG_QUALITY), jpegQuality]
+    while True:
+        ret, image = cap.read()
+        if not ret:
+            break
+        height, width = image.shape[0:2]
+        if width > maxWidth:
+            image = cv.resize(image, (maxWidth, int(round(height * maxWidth / float(width)))), interpolation=cv.INTER_AREA)
+        yield cv.imencode('.jpg', image, encode_param)[1]
+    cap.release()
+
+def peakMemoryMB(who):
+    # ru_maxrss is in KB on Linux, but in bytes on macOS.
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    return maxrss / 1024.0
+
+def printReport(numFrames, elapsed, camera):
+    print ()
+    print (f"{numFrames} frames in {elapsed:.2f}s: {numFrames / elapsed:.1f} frames/s")
+    print (f"Peak RSS: {peakMemoryMB(resource.RUSAGE_SELF):.1f} MB, ffmpeg children: {peakMemoryMB(resource.RUSAGE_CHILDREN):.1f} MB")
+    print (f"Detection events: {camera.numAlerts}")
+    alerts = sorted(f for f in os.listdir(camera.archiver.alerts_dir)
+                    if os.path.isdir(os.path.join(camera.archiver.alerts_dir, f)))
+    for folder in alerts[:20]:
+        print (f"  {folder}")
+    if len(alerts) > 20:
+        print (f"  ... and {len(alerts) - 20} more")
+    print ()
+    print (f"{'step':<16}{'count':>8}{'mean (ms)':>12}{'max (ms)':>12}{'total (s)':>12}")
+    for name, t in sorted(metrics.timings.items()):
+        if t.count == 0:
+            continue
+        print (f"{name:<16}{t.count:>8}{1000*t.total/t.count:>12.2f}{1000*t.max:>12.2f}{t.total:>12.2f}")
+
+def replay(args):
+    if os.path.isdir(args.input):
+        jpegs = readJpegDirectory(args.input)
+    else:
+        jpegs = readVideo(args.input, args.max_width, args.jpeg_quality)
+
+    if args.clear_data_dir and os.path.isdir(args.data_dir):
+        shutil.rmtree(args.data_dir)
+
+    # Never drop frames, the goal is to measure the full processing.
+    args.drop_policy = 'block'
+    encoderPool = ThreadPoolExecutor(max_workers=args.encoder_workers, thread_name_prefix='encoder')
+    stagePool = ThreadPoolExecutor(max_workers=args.processing_workers, thread_name_prefix='stage')
+    camera = watchdog.Camera('replay', None, args.data_dir, args, None, stagePool, encoderPool)
+
+    now = args.start
+    interval = timedelta(seconds=args.interval)
+    numFrames = 0
+    start = time.perf_counter()
+    while args.max_frames is None or numFrames < args.max_frames:
+        with metrics.timed('replay_input'):
+            jpeg = next(jpegs, None)
+        if jpeg is None:
+            break
+        frame = watchdog.Frame(jpeg, now)
+        camera.archiveStage.put(('frame', frame))
+        camera.detectStage.put(frame)
+        now += interval
+        numFrames += 1
+
+    camera.detectStage.close()
+    camera.detectStage.join()
+    camera.archiveStage.close()
+    camera.archiveStage.join()
+    camera.archiver.finalizeActiveAlerts()
+    stagePool.shutdown(wait=True)
+    encoderPool.shutdown(wait=True)
+    camera.archiver.retention.close()
+    elapsed = time.perf_counter() - start
+
+    printReport(numFrames, elapsed, camera)
+
+def parseCommandLine():
+    parser = argparse.ArgumentParser(description='Replay a video or a folder of JPEG images through the watchdog processing and report timings.')
+    parser.add_argument('input', help='Video file or folder of JPEG images')
+    parser.add_argument('--interval', help='Simulated number of seconds between two images', type=float, default=1.0)
+    parser.add_argument('--start', help='Simulated date of the first image, e.g. 2021-03-01T08:00:00. Default is today at midnight',
+                        type=datetime.fromisoformat, default=datetime.now().replace(hour=0, minute=0, second=0, microsecond=0))
+    parser.add_argument('--max-frames', help='Stop after this number of images', type=int)
+    parser.add_argument('--max-width', help='Downscale the video frames to this width, like the image server', type=int, default=640)
+    parser.add_argument('--jpeg-quality', help='Quality used to encode the video frames', type=int, default=90)
+    parser.add_argument('--clear-data-dir', help='Remove the data directory before starting', action='store_true')
+    watchdog.addProcessingArguments(parser)
+    parser.set_defaults(log_level='WARNING')
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = parseCommandLine()
+    watchdog.setupLogging(args.log_level)
+    replay(args)
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+# Keeps the disk usage of the data directory within budgets. Each category
+# (days, alerts, recent) has a maximum size and a maximum age, and its
+# oldest entries get removed first when one of them is exceeded.
+#
+# The size of each entry is kept in an index updated by the archiver when
+# it writes or removes files, and saved to disk, so the tree never has to
+# be walked. Only the top-level listing of each category is compared with
+# the index on startup, to catch the changes made while not running.
+
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger('retention')
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parseSize(s):
+    """Number of bytes of e.g. 500M or 20G."""
+    m = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$', s.strip().upper())
+    if not m:
+        raise ValueError(f"Invalid size {s}, expected e.g. 500M or 20G")
+    return int(float(m.group(1)) * UNITS[m.group(2)])
+
+def pathSize(path):
+    """Size of a file, or of all the files of a folder."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except FileNotFoundError:
+                pass
+    return total
+
+def removePath(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+class Category:
+    """Files of a folder managed together, with their budgets.
+
+    entryName maps a file name of the folder to the name of the entry it
+    belongs to, e.g. the full and small renditions of a day video, or to
+    None if the file is not managed. Entries are evicted as a whole, and
+    onEvict(entryName) can return False to keep an entry that is in use.
+    """
+    def __init__(self, name, directory, maxBytes=None, maxAge=None, entryName=None, onEvict=None):
+        self.name = name
+        self.directory = directory
+        self.maxBytes = maxBytes
+        # In seconds.
+        self.maxAge = maxAge
+        self.entryName = entryName or (lambda fileName: fileName)
+        self.onEvict = onEvict
+
+class RetentionManager:
+    def __init__(self, dataDir, categories, checkInterval=60.0, labels=None):
+        self.indexPath = os.path.join(dataDir, 'retention_index.json')
+        self.usagePath = os.path.join(dataDir, 'storage_usage.json')
+        self.categories = {c.name: c for c in categories}
+        self.checkInterval = checkInterval
+        # Added to the metrics, e.g. the camera name.
+        self.labels = labels or {}
+        self.condition = threading.Condition()
+        # Category name -> entry name -> file name -> (size, mtime).
+        self.index = {c.name: {} for c in categories}
+        self.dirty = False
+        self.overBudget = False
+        self.stopped = False
+        self.lastUsage = None
+        self.loadIndex()
+        self.reconcile()
+        metrics.registerCollector(self.collectMetrics)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def loadIndex(self):
+        try:
+            with open(self.indexPath, 'r') as f:
+                index = json.load(f)
+            for name in self.index:
+                self.index[name] = {entry: {fileName: tuple(v) for fileName, v in files.items()}
+                                    for entry, files in index.get(name, {}).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.warning("Rebuilding the invalid retention index %s: %s", self.indexPath, e)
+            self.index = {name: {} for name in self.index}
+
+    def reconcile(self):
+        for category in self.categories.values():
+            if not os.path.isdir(category.directory):
+                continue
+            fileNames = set(os.listdir(category.directory))
+            indexed = set()
+            for entry, files in list(self.index[category.name].items()):
+                for fileName in list(files):
+                    indexed.add(fileName)
+                    if fileName not in fileNames:
+                        self.removeLocked(category, fileName)
+            for fileName in fileNames - indexed:
+                self.updateLocked(category, fileName)
+
+    def updateLocked(self, category, fileName):
+        entry = category.entryName(fileName)
+        if entry is None:
+            return
+        path = os.path.join(category.directory, fileName)
+        try:
+            st = os.stat(path)
+            size = pathSize(path)
+        except FileNotFoundError:
+            self.removeLocked(category, fileName)
+            return
+        self.index[category.name].setdefault(entry, {})[fileName] = (size, st.st_mtime)
+        self.dirty = True
+
+    def removeLocked(self, category, fileName):
+        entry = category.entryName(fileName)
+        files = self.index[category.name].get(entry)
+        if files is None or fileName not in files:
+            return
+        del files[fileName]
+        if not files:
+            del self.index[category.name][entry]
+        self.dirty = True
+
+    def fileChanged(self, categoryName, fileName):
+        """Called after writing a file, or a folder, of a category."""
+        with self.condition:
+            self.updateLocked(self.categories[categoryName], fileName)
+            # The index and the usage get saved by the periodic check,
+            # only wake up the thread if something has to be removed now.
+            if self.isOverBudgetLocked(categoryName):
+                self.overBudget = True
+                self.condition.notify()
+
+    def fileRemoved(self, categoryName, fileName):
+        with self.condition:
+            self.removeLocked(self.categories[categoryName], fileName)
+
+    def isOverBudgetLocked(self, categoryName):
+        category = self.categories[categoryName]
+        return category.maxBytes is not None and self.totalBytesLocked(categoryName) > category.maxBytes
+
+    def totalBytesLocked(self, categoryName):
+        return sum(size for files in self.index[categoryName].values() for size, _ in files.values())
+
+    def entriesToEvictLocked(self, category, now):
+        """(entry, reason) of the category, oldest first. The newest entry is always kept."""
+        entries = sorted(self.index[category.name].items(), key=lambda kv: max(mtime for _, mtime in kv[1].values()))
+        totalBytes = self.totalBytesLocked(category.name)
+        toEvict = []
+        for entry, files in entries[:-1]:
+            entryBytes = sum(size for size, _ in files.values())
+            if category.maxAge is not None and now - max(mtime for _, mtime in files.values()) > category.maxAge:
+                toEvict.append((entry, 'age'))
+            elif category.maxBytes is not None and totalBytes > category.maxBytes:
+                toEvict.append((entry, 'size'))
+            else:
+                break
+            totalBytes -= entryBytes
+        return toEvict
+
+    def evict(self, now=None):
+        """Removes the entries over budget, returns how many got removed."""
+        now = now or time.time()
+        numEvicted = 0
+        for category in self.categories.values():
+            with self.condition:
+                toEvict = [(entry, reason, list(self.index[category.name][entry]))
+                           for entry, reason in self.entriesToEvictLocked(category, now)]
+            for entry, reason, fileNames in toEvict:
+                if category.onEvict and category.onEvict(entry) is False:
+                    logger.debug("Keeping %s %s, still in use", category.name, entry)
+                    continue
+                logger.info("Removing %s %s (%s budget)", category.name, entry, reason)
+                for fileName in fileNames:
+                    removePath(os.path.join(category.directory, fileName))
+                with self.condition:
+                    for fileName in fileNames:
+                        self.removeLocked(category, fileName)
+                metrics.counter('retention_evictions_total', category=category.name, reason=reason, **self.labels).inc()
+                numEvicted += 1
+        return numEvicted
+
+    def usageLocked(self):
+        usage = {}
+        for name, category in self.categories.items():
+            usage[name] = {
+                'bytes': self.totalBytesLocked(name),
+                'entries': len(self.index[name]),
+                'max_bytes': category.maxBytes,
+                'max_age_days': category.maxAge / (24*3600.) if category.maxAge is not None else None,
+            }
+        return usage
+
+    def writeJsonLocked(self, path, data):
+        # Atomic so the web server never reads a partial file.
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmpPath, path)
+
+    def saveLocked(self):
+        if self.dirty:
+            index = {name: {entry: {fileName: list(v) for fileName, v in files.items()} for entry, files in entries.items()}
+                     for name, entries in self.index.items()}
+            self.writeJsonLocked(self.indexPath, index)
+            self.dirty = False
+        usage = self.usageLocked()
+        if usage != self.lastUsage:
+            self.writeJsonLocked(self.usagePath, usage)
+            self.lastUsage = usage
+
+    def run(self):
+        nextCheck = time.monotonic() + self.checkInterval
+        while True:
+            with self.condition:
+                while not self.overBudget and not self.stopped:
+                    timeout = nextCheck - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if self.stopped:
+                    return
+                overBudget = self.overBudget
+                self.overBudget = False
+            if overBudget:
+                self.enforce(save=False)
+            else:
+                # Also applies the age budgets.
+                self.enforce()
+                nextCheck = time.monotonic() + self.checkInterval
+
+    def enforce(self, save=True):
+        try:
+            with metrics.timed('retention'):
+                self.evict()
+            if save:
+                with self.condition:
+                    self.saveLocked()
+        except Exception:
+            logger.exception("Could not apply the retention budgets")
+
+    def close(self):
+        """Applies the budgets and saves the index one last time."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        self.enforce()
+
+    def collectMetrics(self):
+        samples = []
+        with self.condition:
+            for name, usage in self.usageLocked().items():
+                labels = dict(self.labels, category=name)
+                samples.append(('storage_bytes', 'gauge', labels, usage['bytes']))
+                samples.append(('storage_entries', 'gauge', labels, usage['entries']))
+                samples.append(('storage_max_bytes', 'gauge', labels, usage['max_bytes']))
+        return samples
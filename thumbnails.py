@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Small JPEG versions of the images shown by the web page, so that a phone
+# does not download every full size image. The alert posters get theirs
+# when written by the watchdog, the other images lazily in a bounded disk
+# cache of the web server.
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import cv2 as cv
+import numpy as np
+
+# Width of the alert videos on the web page.
+THUMBNAIL_WIDTH = 480
+THUMBNAIL_QUALITY = 75
+# Subfolder of the image folder with the thumbnails written along the images.
+THUMBNAIL_DIR = 'thumbnails'
+
+def thumbnailPath(imagePath):
+    """e.g. alert/x_annotated.jpg -> alert/thumbnails/x_annotated.jpg"""
+    head, tail = os.path.split(imagePath)
+    return os.path.join(head, THUMBNAIL_DIR, tail)
+
+def encodeThumbnail(image, width=THUMBNAIL_WIDTH):
+    height, imageWidth = image.shape[0:2]
+    if imageWidth > width:
+        image = cv.resize(image, (width, int(round(height * width / float(imageWidth)))), interpolation=cv.INTER_AREA)
+    return cv.imencode('.jpg', image, [int(cv.IMWRITE_JPEG_QUALITY), THUMBNAIL_QUALITY])[1]
+
+def writeThumbnail(path, image):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    encodeThumbnail(image).tofile(path)
+
+def jpegWidth(data):
+    """Width from the frame header of a JPEG buffer, None if not found."""
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        # SOF0 to SOF15, except DHT, JPG and DAC.
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (data[i + 7] << 8) | data[i + 8]
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
+
+def decodeReduced(data, width):
+    """Decodes a JPEG buffer directly at 1/2, 1/4 or 1/8 of its size when still wider than width."""
+    flags = cv.IMREAD_COLOR
+    imageWidth = jpegWidth(data)
+    if imageWidth:
+        for factor, reducedFlags in [(8, cv.IMREAD_REDUCED_COLOR_8), (4, cv.IMREAD_REDUCED_COLOR_4), (2, cv.IMREAD_REDUCED_COLOR_2)]:
+            if imageWidth // factor >= width:
+                flags = reducedFlags
+                break
+    return cv.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+class ThumbnailCache:
+    """Thumbnails generated on the first request, kept on disk.
+
+    The least recently used ones get removed when the cache gets larger
+    than maxBytes. The files are named after the source path and mtime,
+    so a modified image gets a new thumbnail.
+    """
+    def __init__(self, cacheDir, maxBytes, width=THUMBNAIL_WIDTH):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        self.width = width
+        self.lock = threading.Lock()
+        # File name -> size, least recently used first.
+        self.entries = OrderedDict()
+        self.totalBytes = 0
+        os.makedirs(cacheDir, exist_ok=True)
+        files = []
+        for f in os.listdir(cacheDir):
+            if f.endswith('.jpg'):
+                st = os.stat(os.path.join(cacheDir, f))
+                files.append((st.st_atime, f, st.st_size))
+        for _, f, size in sorted(files):
+            self.entries[f] = size
+            self.totalBytes += size
+
+    def get(self, sourcePath):
+        """Path of the thumbnail of sourcePath, None if it cannot be read."""
+        try:
+            mtime = os.stat(sourcePath).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        fileName = hashlib.sha1(f'{os.path.abspath(sourcePath)}:{mtime}'.encode()).hexdigest() + '.jpg'
+        path = os.path.join(self.cacheDir, fileName)
+        with self.lock:
+            if fileName in self.entries and os.path.exists(path):
+                self.entries.move_to_end(fileName)
+                return path
+        try:
+            with open(sourcePath, 'rb') as f:
+                image = decodeReduced(f.read(), self.width)
+        except FileNotFoundError:
+            return None
+        if image is None:
+            return None
+        jpeg = encodeThumbnail(image, self.width)
+        tmpPath = path + '.tmp'
+        jpeg.tofile(tmpPath)
+        os.replace(tmpPath, path)
+        with self.lock:
+            self.totalBytes += len(jpeg) - self.entries.pop(fileName, 0)
+            self.entries[fileName] = len(jpeg)
+            # Never remove the one just generated.
+            while self.totalBytes > self.maxBytes and len(self.entries) > 1:
+                oldest, size = self.entries.popitem(last=False)
+                self.totalBytes -= size
+                try:
+                    os.remove(os.path.join(self.cacheDir, oldest))
+                except FileNotFoundError:
+                    pass
+        return path
@@ -3,14 +3,19 @@
 import sys
 import time
 from datetime import datetime, timedelta
+import json
 import logging
 import argparse
 import os
 import glob
 import re
 import shutil
+import threading
+import signal
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from collections import namedtuple
+from collections import namedtuple, deque
 
 import imageio
 import ffmpeg
@@ -19,9 +24,17 @@ import numpy as np
 import zmq
 
 import motion_detector
+import pipeline
+import alert_store
+import retention
+import thumbnails
+import metrics
+import wire_protocol
 
 debug = False
 
+logger = logging.getLogger('watchdog')
+
 #  tmp_motion_alert_buffer/
 #    1 image per second over the past 30 seconds
 #    transformed into gif once motion alert confirmed
@@ -39,68 +52,489 @@ def isSameDay(time1, time2):
 def isSameHour(time1, time2):
     return isSameDay(time1, time2) and (time1.hour == time2.hour)
 
-def createMp4(filenames, outputMp4):
-    images = [cv.imread(f) for f in filenames]
-    height, width = images[0].shape[0:2]
-
-    ffmpeg_process = (
-        ffmpeg
-        .input('pipe:', format='rawvideo', pix_fmt='bgr24', s='{}x{}'.format(width, height))
-        .output(outputMp4, pix_fmt='yuv420p', vcodec='libx264')
-        .run_async(pipe_stdin=True)
-    )
-    for image in images:
-        print ('image.shape', image.shape)
-        ffmpeg_process.stdin.write(
-            image
-            .astype(np.uint8)
-            .tobytes()
+def runLoggingExceptions(fn, *args):
+    # Exceptions raised in an executor are otherwise silently swallowed.
+    try:
+        fn(*args)
+    except Exception:
+        logger.exception("Background task failed")
+
+# Each mp4 is written in several renditions: the full resolution one, and
+# a small one that starts quickly on phones over cellular. The index gets
+# moved to the beginning of the files (+faststart) so the playback can
+# start before the download finishes.
+Rendition = namedtuple('Rendition', 'suffix max_width preset crf')
+RENDITIONS = [
+    Rendition(suffix='', max_width=None, preset='medium', crf=23),
+    Rendition(suffix='_small', max_width=480, preset='medium', crf=30),
+]
+
+def renditionPath(mp4Path, rendition):
+    """e.g. before_and_after.mp4 -> before_and_after_small.mp4"""
+    return mp4Path[:-len('.mp4')] + rendition.suffix + '.mp4'
+
+def renditionOutputs(stream, outputMp4, **kwargs):
+    """Encodes the stream once per rendition, into temporary files."""
+    streams = stream.split()
+    outputs = []
+    for i, r in enumerate(RENDITIONS):
+        s = streams[i]
+        if r.max_width:
+            s = s.filter('scale', w=f'min({r.max_width},iw)', h=-2)
+        outputs.append(s.output(renditionPath(outputMp4, r) + '.tmp', format='mp4', pix_fmt='yuv420p', vcodec='libx264',
+                                preset=r.preset, crf=r.crf, movflags='+faststart', **kwargs))
+    return ffmpeg.merge_outputs(*outputs)
+
+def renditionEntryName(fileName):
+    """Groups the renditions of an mp4 for the retention, None for other files."""
+    if not fileName.endswith('.mp4'):
+        return None
+    for r in RENDITIONS:
+        if r.suffix and fileName.endswith(r.suffix + '.mp4'):
+            return fileName[:-len(r.suffix + '.mp4')] + '.mp4'
+    return fileName
+
+def replaceRenditions(outputMp4):
+    # The web server lets the clients cache the videos, never expose a
+    # partially written one. The full rendition comes last since it is
+    # the one telling that the video is ready.
+    for r in reversed(RENDITIONS):
+        os.replace(renditionPath(outputMp4, r) + '.tmp', renditionPath(outputMp4, r))
+
+def createMp4(filenames, outputMp4, jpegPassThrough=False):
+    # Frames are streamed one by one to ffmpeg so the memory usage does
+    # not depend on the length of the video.
+    if jpegPassThrough:
+        # Let ffmpeg decode the JPEG files, nothing gets decoded in Python.
+        ffmpeg_process = (
+            renditionOutputs(ffmpeg.input('pipe:', format='image2pipe', vcodec='mjpeg', framerate=25), outputMp4)
+            .overwrite_output()
+            .global_args('-hide_banner', '-loglevel', 'error')
+            .run_async(pipe_stdin=True)
         )
+        for f in filenames:
+            with open(f, 'rb') as jpeg:
+                shutil.copyfileobj(jpeg, ffmpeg_process.stdin)
+    else:
+        ffmpeg_process = None
+        for f in filenames:
+            image = cv.imread(f)
+            if image is None:
+                logger.warning("Could not read %s, skipping it", f)
+                continue
+            if ffmpeg_process is None:
+                height, width = image.shape[0:2]
+                ffmpeg_process = (
+                    renditionOutputs(ffmpeg.input('pipe:', format='rawvideo', pix_fmt='bgr24', s='{}x{}'.format(width, height)), outputMp4)
+                    .overwrite_output()
+                    .global_args('-hide_banner', '-loglevel', 'error')
+                    .run_async(pipe_stdin=True)
+                )
+            elif image.shape[0:2] != (height, width):
+                image = cv.resize(image, (width, height))
+            # imread returns a contiguous uint8 array, write its buffer as is.
+            ffmpeg_process.stdin.write(image.data)
+        if ffmpeg_process is None:
+            return
     ffmpeg_process.stdin.close()
-    ffmpeg_process.wait()
-    print ("{} written".format(outputMp4))
+    if ffmpeg_process.wait() != 0:
+        # e.g. a full disk. The caller keeps the images to retry later.
+        for r in RENDITIONS:
+            if os.path.exists(renditionPath(outputMp4, r) + '.tmp'):
+                os.remove(renditionPath(outputMp4, r) + '.tmp')
+        raise ffmpeg.Error('ffmpeg', None, f"exit code {ffmpeg_process.returncode} while writing {outputMp4}".encode())
+    replaceRenditions(outputMp4)
+    logger.info("%s written", outputMp4)
+
+class DaySummaryEncoder:
+    """Incrementally builds the summary video of a day.
+
+    Each snapshot is encoded only once into a single-frame segment, and the
+    partial or final mp4 is obtained by concatenating the segments with
+    ffmpeg's concat demuxer, without re-encoding anything.
+    """
+    def __init__(self, tmpDayDir):
+        self.tmpDayDir = tmpDayDir
+        self.segmentsDir = os.path.join(tmpDayDir, 'segments')
+        if not os.path.isdir(self.segmentsDir):
+            os.makedirs(self.segmentsDir)
+        # Segments left by a previous run are reused if they have all the
+        # renditions.
+        existing = set(os.listdir(self.segmentsDir))
+        renditionSuffixes = tuple(r.suffix + '.mp4' for r in RENDITIONS if r.suffix)
+        self.segments = sorted(f for f in existing
+                               if f.endswith('.mp4') and not f.endswith(renditionSuffixes)
+                               and all(renditionPath(f, r) in existing for r in RENDITIONS))
+        for r in RENDITIONS:
+            with open(self.concatListPath(r), 'w') as f:
+                for segment in self.segments:
+                    f.write(self.concatEntry(renditionPath(segment, r)))
+
+    def concatListPath(self, rendition):
+        return os.path.join(self.segmentsDir, 'concat' + rendition.suffix + '.txt')
+
+    def concatEntry(self, segment):
+        # Paths are relative to the list file.
+        return "file '{}'\n".format(segment)
+
+    def addImage(self, imagePath):
+        segment = os.path.splitext(os.path.basename(imagePath))[0] + '.mp4'
+        if segment in self.segments:
+            return
+        segmentPath = os.path.join(self.segmentsDir, segment)
+        try:
+            (
+                renditionOutputs(ffmpeg.input(imagePath), segmentPath, r=25, vframes=1)
+                .overwrite_output()
+                .run(quiet=True)
+            )
+        except ffmpeg.Error as e:
+            logger.error("Could not encode %s: %s", imagePath, e.stderr.decode(errors='replace'))
+            return
+        replaceRenditions(segmentPath)
+        self.segments.append(segment)
+        for r in RENDITIONS:
+            with open(self.concatListPath(r), 'a') as f:
+                f.write(self.concatEntry(renditionPath(segment, r)))
+
+    def catchUp(self, imageFiles):
+        # Encodes the images that do not have a segment yet, typically
+        # the new snapshot, or the images saved by an older version.
+        for imagePath in imageFiles:
+            self.addImage(imagePath)
+
+    def writeMp4(self, outputMp4):
+        if len(self.segments) == 0:
+            return
+        # Write to temporary files first so the web server never serves a
+        # partially written video.
+        for r in RENDITIONS:
+            (
+                ffmpeg
+                .input(self.concatListPath(r), format='concat', safe=0)
+                .output(renditionPath(outputMp4, r) + '.tmp', format='mp4', c='copy', movflags='+faststart')
+                .overwrite_output()
+                .run(quiet=True)
+            )
+        replaceRenditions(outputMp4)
+        logger.info("%s written", outputMp4)
+
+class Frame:
+    """A frame received from the image server.
+
+    The original JPEG buffer is kept so it can be archived as is, and it
+    only gets decoded when the pixels are actually needed.
+    """
+    def __init__(self, jpeg, time):
+        self.jpeg = jpeg
+        self.time = time
+        self._image = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            with metrics.timed('decode'):
+                self._image = cv.imdecode(self.jpeg, cv.IMREAD_COLOR)
+        return self._image
+
+class RecentFrameBuffer:
+    """Fixed-capacity ring buffer of the most recent JPEG frames.
+
+    The frames are kept as the encoded buffers received from the image
+    server, along with their timestamp.
+    """
+    def __init__(self, capacity):
+        self.frames = deque(maxlen=capacity)
+
+    def append(self, timestamp, jpeg):
+        self.frames.append((timestamp, jpeg))
+
+    def snapshot(self, since=None):
+        frames = list(self.frames)
+        if since is not None:
+            first = bisect.bisect_left([t for t, _ in frames], since)
+            frames = frames[first:]
+        return frames
+
+def alertFrameName(timestamp):
+    # Microseconds since the active mode sends several frames per second.
+    # Fixed width, so the names sort in time order.
+    return timestamp.strftime("%Y-%m-%d_%H_%M_%S_%f.jpg")
+
+def writeJpeg(path, jpeg):
+    with open(path, 'wb') as f:
+        f.write(jpeg)
+
+class LatestFrameWriter:
+    """Writes the latest frame to disk in the background for the web server.
+
+    Only the most recent pending frame gets written, so a slow disk just
+    skips frames instead of delaying the archiver.
+    """
+    def __init__(self, outputDir, retention=None):
+        self.outputDir = outputDir
+        self.retention = retention
+        self.pending = None
+        self.lastWrittenPath = None
+        self.condition = threading.Condition()
+        self.removeStaleFrames()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def removeStaleFrames(self):
+        # Only keep the most recent frame from a previous run.
+        images = sorted(f for f in os.listdir(self.outputDir) if f.endswith('.jpg'))
+        for f in os.listdir(self.outputDir):
+            if f not in images[-1:]:
+                os.remove(os.path.join(self.outputDir, f))
+
+    def push(self, imageName, jpeg):
+        with self.condition:
+            self.pending = (imageName, jpeg)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                imageName, jpeg = self.pending
+                self.pending = None
+            imPath = os.path.join(self.outputDir, imageName)
+            # The web server reads it while the next frames of the same
+            # second replace it, never expose a partial file.
+            writeJpeg(imPath + '.tmp', jpeg)
+            os.replace(imPath + '.tmp', imPath)
+            if self.lastWrittenPath and self.lastWrittenPath != imPath:
+                # Could already be removed by the retention.
+                if os.path.exists(self.lastWrittenPath):
+                    os.remove(self.lastWrittenPath)
+                if self.retention:
+                    self.retention.fileRemoved('recent', os.path.basename(self.lastWrittenPath))
+            if self.retention:
+                self.retention.fileChanged('recent', imageName)
+            self.lastWrittenPath = imPath
+
+ActiveAlert = namedtuple('ActiveAlert', 'start_time folder_name folder_path')
+
+class ArchiverState:
+    """What the archiver needs to resume its work after a restart.
+
+    The state is saved to a small JSON file after each change. The file is
+    replaced atomically, so a crash leaves either the old or the new state,
+    never a partially written one.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Time of the last image of the day buffer.
+        self.previousTime = None
+        # Folder name -> start time of the alerts still being recorded.
+        self.activeAlerts = {}
+        # Folder names of the finished alerts waiting for their mp4.
+        self.pendingAlertEncodes = set()
+        # (day buffer folder name, isPartial) of the day videos to generate.
+        self.pendingDayFlushes = set()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            previousTime = state['previous_time']
+            self.previousTime = datetime.fromisoformat(previousTime) if previousTime else None
+            self.activeAlerts = {name: datetime.fromisoformat(t) for name, t in state['active_alerts'].items()}
+            self.pendingAlertEncodes = set(state['pending_alert_encodes'])
+            self.pendingDayFlushes = set((name, isPartial) for name, isPartial in state['pending_day_flushes'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring the invalid state file %s: %s", self.path, e)
+
+    def saveLocked(self):
+        state = {
+            'previous_time': self.previousTime.isoformat() if self.previousTime else None,
+            'active_alerts': {name: t.isoformat() for name, t in self.activeAlerts.items()},
+            'pending_alert_encodes': sorted(self.pendingAlertEncodes),
+            'pending_day_flushes': sorted(self.pendingDayFlushes),
+        }
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.path)
+
+    def update(self, fn):
+        """Applies fn to the state and saves it."""
+        with self.lock:
+            fn(self)
+            self.saveLocked()
+
+    def setPreviousTime(self, previousTime):
+        def apply(state):
+            state.previousTime = previousTime
+        self.update(apply)
+
+    def alertStarted(self, folderName, startTime):
+        def apply(state):
+            state.activeAlerts[folderName] = startTime
+        self.update(apply)
+
+    def alertFinished(self, folderName):
+        def apply(state):
+            state.activeAlerts.pop(folderName, None)
+            state.pendingAlertEncodes.add(folderName)
+        self.update(apply)
+
+    def alertEncoded(self, folderName):
+        def apply(state):
+            state.pendingAlertEncodes.discard(folderName)
+        self.update(apply)
+
+    def dayFlushScheduled(self, dayDirName, isPartial):
+        def apply(state):
+            state.pendingDayFlushes.add((dayDirName, isPartial))
+        self.update(apply)
+
+    def dayFlushed(self, dayDirName, isPartial):
+        def apply(state):
+            state.pendingDayFlushes.discard((dayDirName, isPartial))
+        self.update(apply)
 
 class Archiver:    
-    def __init__(self, options):
+    def __init__(self, options, encoderPool=None, dataDir=None, cameraName=None):
         self.options = options
-        self.day_buffer_dir = os.path.join(self.options.data_dir, 'tmp_day_buffer')
+        self.data_dir = dataDir or options.data_dir
+        # The mp4 files get generated in this pool when specified,
+        # otherwise synchronously.
+        self.encoderPool = encoderPool
+        self.day_buffer_dir = os.path.join(self.data_dir, 'tmp_day_buffer')
         if not os.path.isdir(self.day_buffer_dir):
             os.makedirs(self.day_buffer_dir)
 
-        self.recent_buffer_dir = os.path.join(self.options.data_dir, 'tmp_recent_buffer')
+        self.recent_buffer_dir = os.path.join(self.data_dir, 'tmp_recent_buffer')
         if not os.path.isdir(self.recent_buffer_dir):
             os.makedirs(self.recent_buffer_dir)
-
-        self.alerts_dir = os.path.join(self.options.data_dir, 'alerts')
+        self.alerts_dir = os.path.join(self.data_dir, 'alerts')
         if not os.path.isdir(self.alerts_dir):
             os.makedirs(self.alerts_dir)
 
-        self.alert_db = str(Path(self.alerts_dir) / 'alerts.db')
-        open(self.alert_db, 'a') # make sure it gets created
+        self.days_dir = os.path.join(self.data_dir, 'days')
+        if not os.path.isdir(self.days_dir):
+            os.makedirs(self.days_dir)
+
+        alertStorePath = os.path.join(self.alerts_dir, 'alerts.sqlite')
+        isNewStore = not os.path.exists(alertStorePath)
+        self.alertStore = alert_store.AlertStore(alertStorePath)
+        legacyAlertDb = os.path.join(self.alerts_dir, 'alerts.db')
+        if isNewStore and os.path.exists(legacyAlertDb):
+            logger.info("Importing the alerts of %s", legacyAlertDb)
+            self.alertStore.importLegacyDb(legacyAlertDb, self.alerts_dir)
 
         self.previousTime = None
-        self.fakePreviousNow = None
+        self.dayEncoder = None
+        # Held for the whole encoding, only by the encoder workers.
+        self.dayEncoderLock = threading.Lock()
+        # Short, also taken by the archive stage when scheduling a flush.
+        self.pendingDayFlushesLock = threading.Lock()
+        self.pendingDayFlushes = set()
         self.activeAlerts = []
+        self.state = ArchiverState(os.path.join(self.data_dir, 'archiver_state.json'))
+        self.retention = self.createRetentionManager(cameraName)
+        self.recentFrames = RecentFrameBuffer(self.options.recent_buffer_size)
+        self.latestFrameWriter = None
+        if self.options.save_latest_image:
+            self.latestFrameWriter = LatestFrameWriter(self.recent_buffer_dir, self.retention)
+        self.resume()
+
+    def createRetentionManager(self, cameraName):
+        def budget(name):
+            maxSize = getattr(self.options, f'{name}_max_size')
+            maxAge = getattr(self.options, f'{name}_max_age')
+            return dict(maxBytes=maxSize, maxAge=maxAge * 24*3600. if maxAge is not None else None)
+        categories = [
+            retention.Category('days', self.days_dir, entryName=renditionEntryName, **budget('days')),
+            retention.Category('alerts', self.alerts_dir, entryName=lambda f: f if re.match(r'\d\d\d\d-\d\d-\d\d_', f) else None,
+                               onEvict=self.evictAlert, **budget('alerts')),
+            retention.Category('recent', self.recent_buffer_dir, entryName=lambda f: f if f.endswith('.jpg') else None,
+                               **budget('recent')),
+        ]
+        labels = {'camera': cameraName} if cameraName else {}
+        return retention.RetentionManager(self.data_dir, categories, labels=labels)
+
+    def evictAlert(self, folderName):
+        # Still being recorded or encoded.
+        if folderName in self.state.activeAlerts or folderName in self.state.pendingAlertEncodes:
+            return False
+        self.alertStore.remove(folderName)
+        return True
+
+    def runInBackground(self, fn, *args):
+        if self.encoderPool:
+            self.encoderPool.submit(runLoggingExceptions, fn, *args)
+        else:
+            fn(*args)
+
+    def resume(self):
+        """Picks up the work left by the previous run, from the saved state."""
+        self.previousTime = self.state.previousTime
+        for folderName, startTime in sorted(self.state.activeAlerts.items()):
+            folderPath = Path(self.alerts_dir) / folderName
+            if folderPath.is_dir():
+                logger.info("Resuming the recording of alert %s", folderName)
+                # Finalized with the next image if it's already too old.
+                self.activeAlerts.append(ActiveAlert(start_time=startTime, folder_name=folderName, folder_path=folderPath))
+            else:
+                self.state.alertFinished(folderName)
+                self.state.alertEncoded(folderName)
+        for folderName in sorted(self.state.pendingAlertEncodes):
+            folderPath = Path(self.alerts_dir) / folderName
+            if folderPath.is_dir():
+                logger.info("Resuming the encoding of alert %s", folderName)
+                self.runInBackground(self.encodeAlert, ActiveAlert(start_time=None, folder_name=folderName, folder_path=folderPath))
+            else:
+                self.state.alertEncoded(folderName)
+        for dayDirName, isPartial in sorted(self.state.pendingDayFlushes):
+            day = datetime.strptime(dayDirName, "%Y-%m-%d")
+            logger.info("Resuming the generation of the %s video", dayDirName)
+            self.scheduleFlushDay(os.path.join(self.day_buffer_dir, dayDirName), day.year, day.month, day.day, isPartial)
 
-    def maybeGuessPreviousTimeFromLastRun(self, imageDir, now):
-        files = sorted(glob.glob(imageDir + '/*.jpg'))
-        if len(files) > 0:
-            mostRecent = os.path.basename(files[-1])
-            print (mostRecent)
-            m = re.match("(\d\d)_(\d\d)_(\d\d).jpg", mostRecent)
-            if m:
-                hour = int(m.group(1))
-                minute = int(m.group(2))
-                second = int(m.group(3))
-                self.previousTime = now.replace(hour=hour, minute=minute, second=second)
-                print ("[Debug] previous time was ", self.previousTime)
+    def dayEncoderFor(self, tmpDayDir):
+        if self.dayEncoder is None or self.dayEncoder.tmpDayDir != tmpDayDir:
+            self.dayEncoder = DaySummaryEncoder(tmpDayDir)
+        return self.dayEncoder
+
+    def scheduleFlushDay(self, tmpDayDir, year, month, day, isPartial):
+        # A partial video that is already waiting to be generated will
+        # include the new images, no need to schedule another one.
+        with self.pendingDayFlushesLock:
+            if (tmpDayDir, isPartial) in self.pendingDayFlushes:
+                return
+            self.pendingDayFlushes.add((tmpDayDir, isPartial))
+            self.state.dayFlushScheduled(os.path.basename(tmpDayDir), isPartial)
+        self.runInBackground(self.flushDay, tmpDayDir, year, month, day, isPartial)
 
     def flushDay(self, tmpDayDir, year, month, day, isPartial):
+        with self.pendingDayFlushesLock:
+            self.pendingDayFlushes.discard((tmpDayDir, isPartial))
+        with self.dayEncoderLock:
+            self.flushDayLocked(tmpDayDir, year, month, day, isPartial)
+        with self.pendingDayFlushesLock:
+            # Unless new images got scheduled meanwhile.
+            if (tmpDayDir, isPartial) not in self.pendingDayFlushes:
+                self.state.dayFlushed(os.path.basename(tmpDayDir), isPartial)
+
+    def flushDayLocked(self, tmpDayDir, year, month, day, isPartial):
+        if not os.path.isdir(tmpDayDir):
+            # Already finalized.
+            return
         imageFiles = sorted(glob.glob(tmpDayDir + '/*.jpg'))
         if len(imageFiles) > 0:
-            outputDir = os.path.join(self.options.data_dir, 'days')
-            if not os.path.isdir(outputDir):
-                os.makedirs(outputDir)
+            dayEncoder = self.dayEncoderFor(tmpDayDir)
+            with metrics.timed('mp4_encode'):
+                dayEncoder.catchUp(imageFiles)
+            outputDir = self.days_dir
             mp4Filename = None
             if isPartial:
                 mp4Filename = "{:04d}-{:02d}-{:02d}_partial_{:03d}.mp4".format(year, month, day, len(imageFiles))
@@ -109,16 +543,20 @@ class Archiver:
                 partialFiles = glob.glob(outputDir + '/{:04d}-{:02d}-{:02d}_partial*.mp4'.format(year, month, day))
                 for f in partialFiles:
                     os.remove (f)
+                    self.retention.fileRemoved('days', os.path.basename(f))
             outputMp4 = os.path.join(outputDir, mp4Filename)
-            createMp4(imageFiles, outputMp4)
+            with metrics.timed('mp4_concat'):
+                dayEncoder.writeMp4(outputMp4)
+            for r in RENDITIONS:
+                self.retention.fileChanged('days', os.path.basename(renditionPath(outputMp4, r)))
         if (not isPartial):
             shutil.rmtree(tmpDayDir)
+            if self.dayEncoder and self.dayEncoder.tmpDayDir == tmpDayDir:
+                self.dayEncoder = None
 
     def maybeFlushPreviousDays(self, now):
-        self.maybeFlushOldAlerts(now)
-
         dayFolders = os.listdir(self.day_buffer_dir)
-        print ('dayFolders', dayFolders)
+        logger.debug("Day folders: %s", dayFolders)
         for dirName in dayFolders:
             fullPath = os.path.join(self.day_buffer_dir, dirName)
             if not os.path.isdir(fullPath):
@@ -131,36 +569,12 @@ class Archiver:
             day = int(m.group(3))
             if year == now.year and month == now.month and day == now.day:
                 continue 
-            self.flushDay(fullPath, year, month, day, isPartial=False)
+            self.scheduleFlushDay(fullPath, year, month, day, isPartial=False)
 
-    def maybeFlushOldAlerts(self, now):        
-        alertFolders = os.listdir(self.alerts_dir)
-        print ('alertFolders', alertFolders)
-        for dirName in alertFolders:
-            fullPath = os.path.join(self.alerts_dir, dirName)
-            if not os.path.isdir(fullPath):
-                continue
-            m = re.match("(\d\d\d\d)-(\d\d)-(\d\d)", dirName)
-            if not m:
-                continue
-            year = int(m.group(1))
-            month = int(m.group(2))
-            day = int(m.group(3))
-            # Keep alerts for 30 days.
-            if (now - datetime(year=year, month=month, day=day) < timedelta(days=30)):
-                print ("Keeping recent alert " + dirName)
-                continue 
-            print ("Removing old alert " + dirName)
-            shutil.rmtree(fullPath)
-
-    def handleDayBuffer(self, now, image):
+    def handleDayBuffer(self, now, jpeg):
         imageDirName = now.strftime("%Y-%m-%d")
         imageDir = os.path.join(self.day_buffer_dir, imageDirName)
 
-        # try to guess the previousTime from a previous run,
-        if not self.previousTime and os.path.isdir(imageDir):
-            self.maybeGuessPreviousTimeFromLastRun(imageDir, now)
-
         if self.previousTime and not isSameDay(now, self.previousTime):
             self.maybeFlushPreviousDays(now)
 
@@ -176,136 +590,569 @@ class Archiver:
 
         imageName = now.strftime("%H_%M_%S.jpg")
         imPath = os.path.join(imageDir, imageName)
-        cv.imwrite(imPath, image)
-        self.flushDay(imageDir, now.year, now.month, now.day, isPartial=True)
-
-    def handleRecentBuffer(self, now, image):
-        imageName = now.strftime("%Y-%m-%d_%H_%M_%S.jpg")
-        imPath = os.path.join(self.recent_buffer_dir, imageName)
-        cv.imwrite(imPath, image)
-        images = sorted (os.listdir(self.recent_buffer_dir))
-        if (len(images) > self.options.recent_buffer_size):
-            toRemove = images[0:len(images)-self.options.recent_buffer_size]
-            for f in toRemove:
-                os.remove(os.path.join(self.recent_buffer_dir, f))    
-
-    def handleCurrentAlert(self, now, image):
+        writeJpeg(imPath, jpeg)
+        self.state.setPreviousTime(now)
+        self.scheduleFlushDay(imageDir, now.year, now.month, now.day, isPartial=True)
+
+    def handleRecentBuffer(self, now, jpeg):
+        self.recentFrames.append(now, jpeg)
+        if self.latestFrameWriter:
+            self.latestFrameWriter.push(now.strftime("%Y-%m-%d_%H_%M_%S.jpg"), jpeg)
+
+    def handleCurrentAlert(self, now, jpeg):
         alerts_to_remove = []
         for alert in self.activeAlerts:
-            if (now-alert.start_time).seconds > self.options.seconds_to_record_after_alert:
+            if (now-alert.start_time).total_seconds() > self.options.seconds_to_record_after_alert:
                 alerts_to_remove.append(alert)
                 continue
-            imageName = now.strftime("%Y-%m-%d_%H_%M_%S.jpg")            
-            cv.imwrite(str(alert.folder_path / imageName), image)
+            writeJpeg(alert.folder_path / alertFrameName(now), jpeg)
         
         for a in alerts_to_remove:
             self.finalizeAlert (a)
 
     def finalizeAlert(self, alert):
-        print (f"Alert {alert.folder_name} is finished, generating the mp4")        
+        self.activeAlerts.remove(alert)
+        self.state.alertFinished(alert.folder_name)
+        self.runInBackground(self.encodeAlert, alert)
+
+    def encodeAlert(self, alert):
+        logger.info("Alert %s is finished, generating the mp4", alert.folder_name)
         recorded_files = sorted(alert.folder_path.glob('*.jpg'))
         recorded_files = [str(f) for f in recorded_files]
         outputMp4 = str(alert.folder_path / 'before_and_after.mp4')
-        createMp4(recorded_files, outputMp4)
+        # The mp4 is only renamed to its final name once complete. If it
+        # exists, a previous run got interrupted before the cleanup.
+        if not os.path.exists(outputMp4):
+            with metrics.timed('mp4_encode'):
+                createMp4(recorded_files, outputMp4, jpegPassThrough=self.options.mp4_jpeg_passthrough)
         for f in recorded_files:
             if not '_annotated.jpg' in f:
                 os.remove(f)
-        self.activeAlerts.remove(alert)
+        self.state.alertEncoded(alert.folder_name)
+        self.retention.fileChanged('alerts', alert.folder_name)
 
-    def recordNewAlert(self, r: motion_detector.Results):
+    def recordNewAlert(self, r: motion_detector.Results, frame):
         event_name = r.event.name
-        now = datetime.now()
+        now = frame.time
         formatted_now = now.strftime(f"%Y-%m-%d_%H_%M_%S")
         folder_name = f"{formatted_now}_{event_name}"
         folder_path = Path(self.alerts_dir) / folder_name
         os.makedirs(folder_path)
-        print ("Recording new alert into ", folder_name)
+        logger.info("Recording new alert into %s", folder_name)
 
-        images = sorted (os.listdir(self.recent_buffer_dir))
-        for im in images:
-            shutil.copy(os.path.join(self.recent_buffer_dir, im), folder_path / im)
+        for timestamp, jpeg in self.recentFrames.snapshot():
+            writeJpeg(folder_path / alertFrameName(timestamp), jpeg)
 
         # Save the annotated image.
         annotated_image_name = f"{formatted_now}_{event_name}_annotated.jpg"
-        cv.imwrite(str(folder_path / annotated_image_name), r.annotated_image)
+        # Only drawn now, on a copy, the frame itself is never modified.
+        annotated_image = r.annotate(frame.image)
+        cv.imwrite(str(folder_path / annotated_image_name), annotated_image)
+        # Shown as the poster of the alert video on the web page.
+        thumbnails.writeThumbnail(thumbnails.thumbnailPath(str(folder_path / annotated_image_name)), annotated_image)
 
-        Alert = namedtuple('Alert', 'start_time folder_name folder_path')
-        active_alert = Alert(start_time = now, folder_name=folder_name, folder_path=folder_path)
-        with open(self.alert_db, 'a') as f:
-            json_str = f'{{"folder_name": "{folder_name}"}}'
-            f.write(f"{formatted_now} {event_name} {json_str}\n")
+        active_alert = ActiveAlert(start_time = now, folder_name=folder_name, folder_path=folder_path)
+        self.alertStore.add(now, event_name, folder_name,
+                            f"{folder_name}/{annotated_image_name}",
+                            f"{folder_name}/before_and_after.mp4")
         self.activeAlerts.append (active_alert)
+        self.state.alertStarted(folder_name, now)
+        return active_alert
 
-    def processImage(self, image):
-        now = datetime.now()
+    def saveClip(self, folderPath, mpegts):
+        """Remuxes a clip of the original camera stream into the alert folder."""
+        tsPath = folderPath / 'clip.ts'
+        mp4Path = folderPath / 'clip.mp4'
+        with open(tsPath, 'wb') as f:
+            f.write(mpegts)
+        try:
+            with metrics.timed('clip_remux'):
+                (
+                    ffmpeg
+                    .input(str(tsPath))
+                    .output(str(mp4Path) + '.tmp', format='mp4', c='copy', an=None, movflags='+faststart')
+                    .overwrite_output()
+                    .run(quiet=True)
+                )
+        except ffmpeg.Error as e:
+            logger.error("Could not remux %s, keeping it: %s", tsPath, e.stderr.decode(errors='replace'))
+            self.retention.fileChanged('alerts', folderPath.name)
+            return
+        os.replace(str(mp4Path) + '.tmp', mp4Path)
+        os.remove(tsPath)
+        self.alertStore.setClipPath(folderPath.name, f"{folderPath.name}/clip.mp4")
+        self.retention.fileChanged('alerts', folderPath.name)
+        logger.info("%s written", mp4Path)
 
-        # Option: simulate a super fast clock to see the behavior over days.
-        # if self.fakePreviousNow:
-        #     now = self.fakePreviousNow + timedelta(minutes=5)
-        # self.fakePreviousNow = now
+    def processImage(self, frame):
+        # The frame time can come from a simulated clock, see replay.py.
+        now = frame.time
+        with metrics.timed('day_buffer'):
+            self.handleDayBuffer (now, frame.jpeg)
+        with metrics.timed('recent_buffer'):
+            self.handleRecentBuffer (now, frame.jpeg)
+        with metrics.timed('alert'):
+            self.handleCurrentAlert (now, frame.jpeg)
 
-        self.handleDayBuffer (now, image)        
-        self.handleRecentBuffer (now, image)
-        self.handleCurrentAlert (now, image)
+    def finalizeActiveAlerts(self):
+        for alert in list(self.activeAlerts):
+            self.finalizeAlert(alert)
 
-class WatchDog:
-    def __init__(self, options):
-        self.archiver = Archiver(options)
-        self.motionDetector = motion_detector.Detector()
-        self.zmqCtx = zmq.Context()
+class Camera:
+    """Connection to one image server and the processing of its frames.
+
+    Each camera has its own archiver and detector, and two stages: the
+    detection stage decodes the frames and runs the motion detector, and
+    the archive stage saves them and records the alerts. The stages of all
+    the cameras run on the same shared pool.
+    """
+    def __init__(self, name, url, dataDir, options, zmqCtx, stagePool, encoderPool, cameraId=0, liveSocket=None, controlUrl=None, clipUrl=None):
+        self.name = name
+        self.url = url
+        # Optional control channel to ask the image server for the active
+        # frame rate while there is motion.
+        self.controlUrl = controlUrl
+        self.controlSocket = None
+        self.lastMotionTime = 0
+        self.lastActiveRequestTime = 0
+        # Optional channel to get full resolution clips of the alerts.
+        self.clipUrl = clipUrl
+        self.clipSocket = None
+        # (alert, alert time) filled by the archive stage, sent by the receiver thread.
+        self.clipRequests = deque()
+        # request id -> alert, waiting for their clip.
+        self.pendingClips = {}
+        self.numClipRequests = 0
+        self.cameraId = cameraId
+        # Optional zmq PUB socket to forward the received frames to the web server.
+        self.liveSocket = liveSocket
         self.options = options
-        if not os.path.isdir(self.options.data_dir):
-            print ("Creating {} to store images and alerts".format(self.options.data_dir))
-            os.makedirs(self.options.data_dir)
+        self.zmqCtx = zmqCtx
+        self.zmqSocket = None
+        if not os.path.isdir(dataDir):
+            logger.info("Creating %s to store images and alerts", dataDir)
+            os.makedirs(dataDir)
+        self.archiver = Archiver(options, encoderPool, dataDir, name)
+        self.writeCameraInfo(dataDir)
+        self.motionDetector = motion_detector.Detector(detectorOptionsFromArgs(options, name))
+        # Several pending frames get decoded and detected in a single batch.
+        self.detectStage = pipeline.PipelineStage(f'{name}/detect', self.detectMotion, stagePool,
+                                                  options.queue_size, options.drop_policy, batch=True)
+        self.archiveStage = pipeline.PipelineStage(f'{name}/archive', self.archive, stagePool,
+                                                   options.queue_size, options.drop_policy)
+        self.numFramesReceived = 0
+        self.numFramesLostInTransit = 0
+        self.numReceiveFailures = 0
+        self.numAlerts = 0
+        self.lastReceiveTime = time.time()
+        self.lastSequence = None
+        self.lastLatency = None
+        self.previewFrame = None
+        self.numReconnects = 0
+        metrics.registerCollector(self.collectMetrics)
+
+    def writeCameraInfo(self, dataDir):
+        # Tells the web server which live frames belong to this folder.
+        path = os.path.join(dataDir, 'camera.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'name': self.name, 'live_camera': self.cameraId}, f)
+        os.replace(path + '.tmp', path)
+
+    def collectMetrics(self):
+        labels = {'camera': self.name}
+        samples = [
+            ('frames_received_total', 'counter', labels, self.numFramesReceived),
+            ('alerts_total', 'counter', labels, self.numAlerts),
+            ('zmq_reconnects_total', 'counter', labels, self.numReconnects),
+            ('latency_seconds', 'gauge', labels, self.lastLatency),
+        ]
+        for stage, dropped in self.droppedFrames().items():
+            samples.append(('frames_dropped_total', 'counter', dict(labels, stage=stage), dropped))
+        for stage in [self.detectStage, self.archiveStage]:
+            samples.append(('queue_length', 'gauge', dict(labels, stage=stage.name.split('/')[-1]), len(stage.items)))
+        return samples
 
     def reconnectToServer(self):
-        print ("Reconnecting to the server...")
+        logger.info("[%s] Reconnecting to the server...", self.name)
+        if self.zmqSocket:
+            self.zmqSocket.close(linger=0)
+            self.numReconnects += 1
         self.zmqSocket = self.zmqCtx.socket(zmq.SUB)
         if self.options.image_server_password:
             self.zmqSocket.plain_username = b'admin'
             self.zmqSocket.plain_password = self.options.image_server_password.encode('ascii')
-        self.zmqSocket.connect(self.options.server_url)
+        self.zmqSocket.connect(self.url)
         self.zmqSocket.setsockopt(zmq.SUBSCRIBE, b'')
-        self.zmqSocket.setsockopt(zmq.RCVTIMEO, 5000)
         self.numReceiveFailures = 0
+        self.lastReceiveTime = time.time()
+        if self.controlUrl and not self.controlSocket:
+            self.controlSocket = self.zmqCtx.socket(zmq.DEALER)
+            if self.options.image_server_password:
+                self.controlSocket.plain_username = b'admin'
+                self.controlSocket.plain_password = self.options.image_server_password.encode('ascii')
+            # Outdated requests are useless, never queue more than one.
+            self.controlSocket.setsockopt(zmq.SNDHWM, 1)
+            self.controlSocket.setsockopt(zmq.LINGER, 0)
+            self.controlSocket.connect(self.controlUrl)
+        if self.clipUrl and not self.clipSocket:
+            self.clipSocket = self.zmqCtx.socket(zmq.DEALER)
+            if self.options.image_server_password:
+                self.clipSocket.plain_username = b'admin'
+                self.clipSocket.plain_password = self.options.image_server_password.encode('ascii')
+            self.clipSocket.setsockopt(zmq.LINGER, 0)
+            self.clipSocket.connect(self.clipUrl)
 
-    def readImages(self):
-        while True:
+    def sendClipRequests(self):
+        while self.clipRequests:
+            alert, alertTime = self.clipRequests.popleft()
+            # The alert frame got received a bit earlier, the clip has to
+            # start earlier and finish earlier accordingly.
+            delay = max(0.0, (datetime.now() - alertTime).total_seconds())
+            self.numClipRequests += 1
+            request = wire_protocol.ClipRequest(request_id=self.numClipRequests,
+                                                seconds_before=self.options.clip_seconds_before + delay,
+                                                seconds_after=max(0.0, self.options.seconds_to_record_after_alert - delay))
             try:
-                jpeg = self.zmqSocket.recv_pyobj()
-            except zmq.error.Again as e:
-                sys.stderr.write ("Could not communicate with the server. Check that the port is open and the password is correct.\n")
-                self.numReceiveFailures += 1
-                if self.numReceiveFailures > 3:
-                    self.reconnectToServer()
+                wire_protocol.sendClipRequest(self.clipSocket, request, zmq.NOBLOCK)
+            except zmq.Again:
+                logger.warning("[%s] Could not request the clip of %s", self.name, alert.folder_name)
                 continue
-            # print (len(jpeg))
-            image = cv.imdecode(jpeg, cv.IMREAD_COLOR)
-            # print (image.shape)
-            if debug:
-                cv.imshow ('received', image)
-            self.archiver.processImage (image)
-            e = self.motionDetector.processImage (image)
+            self.pendingClips[request.request_id] = alert
+            # Forget the oldest ones if the image server never answered.
+            while len(self.pendingClips) > 64:
+                del self.pendingClips[next(iter(self.pendingClips))]
+
+    def receiveClip(self):
+        try:
+            header, mpegts = wire_protocol.receiveClip(self.clipSocket)
+        except wire_protocol.ProtocolError as e:
+            logger.warning("[%s] Ignoring invalid clip: %s", self.name, e)
+            return
+        alert = self.pendingClips.pop(header.request_id, None)
+        if alert is None:
+            logger.warning("[%s] Received an unexpected clip", self.name)
+            return
+        if len(mpegts) == 0:
+            logger.warning("[%s] Received an empty clip for %s", self.name, alert.folder_name)
+            return
+        metrics.counter('clips_received_total', camera=self.name).inc()
+        self.archiver.runInBackground(self.archiver.saveClip, alert.folder_path, mpegts)
+
+    def maybeRequestActiveRate(self):
+        """Keeps the image server in the active mode while there is motion or an alert."""
+        if not self.controlSocket:
+            return
+        now = time.time()
+        activeSeconds = self.options.active_seconds
+        wantsActive = now - self.lastMotionTime < activeSeconds or len(self.archiver.activeAlerts) > 0
+        # Renew the request before it expires on the image server.
+        if not wantsActive or now - self.lastActiveRequestTime < activeSeconds / 2:
+            return
+        request = wire_protocol.ControlRequest(command=wire_protocol.COMMAND_ACTIVE, seconds=activeSeconds)
+        try:
+            wire_protocol.sendControlRequest(self.controlSocket, request, zmq.NOBLOCK)
+        except zmq.Again:
+            logger.debug("[%s] Could not send the control request", self.name)
+        self.lastActiveRequestTime = now
+
+    def handleReceiveTimeout(self):
+        """Returns True if the socket got recreated."""
+        logger.warning("[%s] Could not communicate with the server. Check that the port is open and the password is correct.", self.name)
+        self.lastReceiveTime = time.time()
+        self.numReceiveFailures += 1
+        if self.numReceiveFailures > 3:
+            self.reconnectToServer()
+            return True
+        return False
+
+    def droppedFrames(self):
+        return {'network': self.numFramesLostInTransit,
+                'detect': self.detectStage.numDropped,
+                'archive': self.archiveStage.numDropped}
+
+    def trackSequence(self, header):
+        if self.lastSequence is not None and header.sequence > self.lastSequence + 1:
+            self.numFramesLostInTransit += header.sequence - self.lastSequence - 1
+        self.lastSequence = header.sequence
+        # Only meaningful if the clocks of both machines are synchronized.
+        self.lastLatency = time.time() - header.timestamp
+
+    def printStats(self):
+        dropped = self.droppedFrames()
+        if any(dropped.values()):
+            logger.warning("[%s] %d frames received, dropped per stage: %s, last latency: %s",
+                           self.name, self.numFramesReceived, dropped, self.lastLatency)
+
+    def receiveFrame(self):
+        try:
+            with metrics.timed('receive'):
+                header, jpeg = wire_protocol.receiveFrame(self.zmqSocket, acceptPickle=self.options.legacy_pickle_protocol)
+        except wire_protocol.ProtocolError as e:
+            logger.warning("[%s] Ignoring invalid message: %s", self.name, e)
+            return
+        self.lastReceiveTime = time.time()
+        self.numReceiveFailures = 0
+        self.numFramesReceived += 1
+        if header:
+            self.trackSequence(header)
+        if self.liveSocket:
+            self.publishLiveFrame(header, jpeg)
+        # The archiver only needs the JPEG buffer, the frame gets
+        # decoded by the detection stage.
+        frame = Frame(jpeg, datetime.now())
+        self.archiveStage.put(('frame', frame))
+        self.detectStage.put(frame)
+
+    def publishLiveFrame(self, header, jpeg):
+        # Same buffer as the received one, nothing gets copied.
+        liveHeader = wire_protocol.FrameHeader(camera_id=self.cameraId, sequence=self.numFramesReceived,
+                                               timestamp=header.timestamp if header else time.time(),
+                                               width=header.width if header else 0,
+                                               height=header.height if header else 0,
+                                               encoding=wire_protocol.ENCODING_JPEG)
+        # A PUB socket never blocks, frames are dropped if the subscribers are too slow.
+        wire_protocol.sendFrame(self.liveSocket, liveHeader, jpeg)
+
+    def detectMotion(self, frames):
+        self.previewFrame = frames[-1]
+        images = [frame.image for frame in frames]
+        start = time.perf_counter()
+        results = self.motionDetector.processBatch (images, [frame.time for frame in frames])
+        metrics.timing('detect').recordBatch(time.perf_counter() - start, len(frames))
+        lastRawMotion = self.motionDetector.last_raw_motion_date
+        if lastRawMotion is not None and lastRawMotion >= frames[0].time:
+            self.lastMotionTime = time.time()
+        for frame, e in zip(frames, results):
             if e.event != motion_detector.Event.NONE:
-                self.archiver.recordNewAlert (e)
+                self.numAlerts += 1
+                # Alerts must never be dropped.
+                self.archiveStage.put(('alert', (e, frame)), droppable=False)
+
+    def archive(self, item):
+        kind, content = item
+        if kind == 'frame':
+            self.archiver.processImage (content)
+        else:
+            with metrics.timed('new_alert'):
+                alert = self.archiver.recordNewAlert (*content)
+            if self.clipUrl:
+                self.clipRequests.append((alert, content[1].time))
+
+def detectorOptionsFromArgs(args, cameraName):
+    options = motion_detector.Options()
+    for spec in args.detector_backend:
+        name, sep, backend = spec.rpartition('=')
+        if not sep or name == cameraName:
+            options.backend = backend
+    options.detection_width = args.detection_width
+    options.min_area_fraction = args.min_motion_area
+    options.regions_of_interest = args.detection_region
+    options.excluded_regions = args.excluded_region
+    return options
+
+def cameraUrlFromSpecs(specs, cameraName):
+    """Picks the url of the camera among "url" or "name=url" specs."""
+    cameraUrl = None
+    for spec in specs:
+        name, sep, url = spec.partition('=')
+        if not sep:
+            cameraUrl = spec
+        elif name == cameraName:
+            cameraUrl = url
+    return cameraUrl
+
+def parseRegion(s):
+    region = tuple(float(v) for v in s.split(','))
+    if len(region) != 4:
+        raise argparse.ArgumentTypeError(f"Expected x0,y0,x1,y1, got {s}")
+    return region
+
+def parseCameraSpecs(specs, dataDir):
+    """Returns a list of (name, url, dataDir).
+
+    A single unnamed camera keeps using the data directory directly,
+    otherwise each camera gets its own cameras/<name> subdirectory.
+    """
+    cameras = []
+    for i, spec in enumerate(specs):
+        name, sep, url = spec.partition('=')
+        if not sep:
+            name, url = f'camera{i}', spec
+        cameras.append((name, url))
+    if len(specs) == 1 and '=' not in specs[0]:
+        return [(cameras[0][0], cameras[0][1], dataDir)]
+    return [(name, url, os.path.join(dataDir, 'cameras', name)) for name, url in cameras]
+
+class WatchDog:
+    """Receives the images of all the cameras and processes them.
 
-            k = cv.waitKey(10)
+    A single receiver thread polls the sockets of all the cameras and
+    feeds their processing stages. The mp4 files are generated in a
+    separate pool so a slow ffmpeg run never stalls the reception.
+    """
+    def __init__(self, options):
+        self.options = options
+        self.encoderPool = ThreadPoolExecutor(max_workers=options.encoder_workers, thread_name_prefix='encoder')
+        self.stagePool = ThreadPoolExecutor(max_workers=options.processing_workers, thread_name_prefix='stage')
+        self.zmqCtx = zmq.Context()
+        self.liveSocket = None
+        if options.live_publish_url:
+            self.liveSocket = self.zmqCtx.socket(zmq.PUB)
+            # Only the latest frames matter for the live view.
+            self.liveSocket.setsockopt(zmq.SNDHWM, 2)
+            self.liveSocket.bind(options.live_publish_url)
+        self.cameras = [Camera(name, url, dataDir, options, self.zmqCtx, self.stagePool, self.encoderPool, i, self.liveSocket,
+                               cameraUrlFromSpecs(options.control_url, name), cameraUrlFromSpecs(options.clip_url, name))
+                        for i, (name, url, dataDir) in enumerate(parseCameraSpecs(options.server_urls, options.data_dir))]
+        self.stopEvent = threading.Event()
+        self.lastStatsTime = time.time()
+
+    def connectToServers(self):
+        for camera in self.cameras:
+            camera.reconnectToServer()
+
+    def maybePrintStats(self):
+        now = time.time()
+        if now - self.lastStatsTime < 60:
+            return
+        self.lastStatsTime = now
+        for camera in self.cameras:
+            camera.printStats()
+
+    def receiveImages(self):
+        poller = zmq.Poller()
+        for camera in self.cameras:
+            poller.register(camera.zmqSocket, zmq.POLLIN)
+            if camera.clipSocket:
+                poller.register(camera.clipSocket, zmq.POLLIN)
+        while not self.stopEvent.is_set():
+            events = dict(poller.poll(1000))
+            for camera in self.cameras:
+                if camera.clipSocket:
+                    if camera.clipSocket in events:
+                        camera.receiveClip()
+                    camera.sendClipRequests()
+                if camera.zmqSocket in events:
+                    camera.receiveFrame()
+                elif time.time() - camera.lastReceiveTime > 5:
+                    oldSocket = camera.zmqSocket
+                    if camera.handleReceiveTimeout():
+                        poller.unregister(oldSocket)
+                        poller.register(camera.zmqSocket, zmq.POLLIN)
+                # All the sockets are only used from this thread.
+                camera.maybeRequestActiveRate()
+            self.maybePrintStats()
+
+    def handleStopSignal(self, signum, stackFrame):
+        logger.info("Received signal %d", signum)
+        self.stopEvent.set()
+
+    def runPreview(self):
+        # The GUI calls all happen here, in the main thread, and never in
+        # the processing stages.
+        while not self.stopEvent.is_set():
+            for camera in self.cameras:
+                if camera.previewFrame is not None:
+                    cv.imshow (camera.name, camera.previewFrame.image)
+            k = cv.waitKey(30)
             if k == ord('q'):
                 break
 
+    def readImages(self):
+        signal.signal(signal.SIGINT, self.handleStopSignal)
+        signal.signal(signal.SIGTERM, self.handleStopSignal)
+        receiver = threading.Thread(target=self.receiveImages, daemon=True)
+        receiver.start()
+        if self.options.preview:
+            self.runPreview()
+        else:
+            # Headless, just wait for a stop signal.
+            while not self.stopEvent.wait(1.0):
+                pass
+        self.shutdown(receiver)
+
+    def shutdown(self, receiver):
+        logger.info("Stopping, waiting for the pending frames and videos...")
+        self.stopEvent.set()
+        receiver.join()
+        for camera in self.cameras:
+            camera.detectStage.close()
+            camera.detectStage.join()
+            camera.archiveStage.close()
+            camera.archiveStage.join()
+        self.stagePool.shutdown(wait=True)
+        self.encoderPool.shutdown(wait=True)
+        for camera in self.cameras:
+            camera.archiver.retention.close()
+
+def hasDisplay():
+    if sys.platform in ['win32', 'darwin']:
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
 def parseCommandLine():
     parser = argparse.ArgumentParser(description='Connect to an image server, detect motion alarms and save alerts.')
-    parser.add_argument('server_url', help='Server address and port in zmq format. Example: "tcp://myserver.com:4242"')
+    parser.add_argument('server_urls', nargs='+', metavar='server_url',
+                        help='Server address and port in zmq format, optionally prefixed by a camera name. '
+                             'Example: "tcp://myserver.com:4242" or "garden=tcp://myserver.com:4242"')
     parser.add_argument('--image-server-password', help='Password to connect to the image server')
+    parser.add_argument('--legacy-pickle-protocol', help='Also accept the pickled images sent by older image servers', action='store_true')
+    parser.add_argument('--preview', help='Show the received images in a window, press q to quit. Requires a display', action='store_true')
+    parser.add_argument('--metrics-port', help='Serve Prometheus metrics on http://0.0.0.0:PORT/metrics', type=int)
+    parser.add_argument('--live-publish-url', help='Publish the received frames on this zmq address for the live view of the web server. '
+                                                   'Example: "ipc:///tmp/tiny-watchdog-live" or "tcp://127.0.0.1:4243"')
+    parser.add_argument('--control-url', help='zmq address of the control channel of the image server (its --control-bind-url), optionally prefixed by a camera name. '
+                                              'Used to ask for its active frame rate while there is motion. Example: "tcp://myserver.com:4243" or "garden=tcp://myserver.com:4243"',
+                        action='append', default=[])
+    parser.add_argument('--active-seconds', help='How long each request for the active frame rate lasts', type=float, default=10.0)
+    parser.add_argument('--clip-url', help='zmq address of the clip channel of the image server (its --clip-bind-url), optionally prefixed by a camera name. '
+                                           'Used to save a full resolution clip of each alert. Example: "tcp://myserver.com:4244" or "garden=tcp://myserver.com:4244"',
+                        action='append', default=[])
+    parser.add_argument('--clip-seconds-before', help='Duration of the full resolution clips before the alert. They last --seconds-to-record-after-alert after it', type=float, default=10.0)
+    addProcessingArguments(parser)
+    args = parser.parse_args()
+    if args.preview and not hasDisplay():
+        logger.warning("No display available, running headless.")
+        args.preview = False
+    return args
+
+def addProcessingArguments(parser):
+    """Options related to the processing of the images, also used by replay.py"""
+    parser.add_argument('--log-level', help='Logging level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO')
     parser.add_argument('--data-dir', help='Directory used to save images and alerts', default='data')
-    parser.add_argument('--recent-buffer-size', help='Number of images to keep in the recent buffer', type=int, default=30)
+    parser.add_argument('--recent-buffer-size', help='Number of images to keep in memory in the recent buffer, used as the alert pre-roll', type=int, default=30)
+    parser.add_argument('--no-save-latest-image', dest='save_latest_image', help='Do not write the latest image to disk (used by the web server)', action='store_false')
     parser.add_argument('--num-images-per-day', help='Number of images in the daily summary (default is 4 per hour)', type=int, default=24*4)
-    parser.add_argument('--seconds-to-record-after-alert', help="Number of seconds to record after an alert.", default=10)
-    return parser.parse_args()
+    parser.add_argument('--mp4-jpeg-passthrough', help='Give the JPEG files directly to ffmpeg when creating the alert videos instead of decoding them in Python', action='store_true')
+    parser.add_argument('--seconds-to-record-after-alert', help="Number of seconds to record after an alert.", type=int, default=10)
+    parser.add_argument('--detector-backend', help='Motion detection method, one of {}, default is mog. '
+                        'Use camera=backend to set it for a single camera. Can be repeated'.format(', '.join(sorted(motion_detector.backends))),
+                        action='append', default=[])
+    parser.add_argument('--detection-width', help='Width of the images used for motion detection, 0 for the full resolution', type=int, default=320)
+    parser.add_argument('--min-motion-area', help='Minimum area of a moving region, as a fraction of the image area', type=float, default=0.0013)
+    parser.add_argument('--detection-region', help='Only detect motion in this region, given as x0,y0,x1,y1 fractions of the image size. Can be repeated', type=parseRegion, action='append', default=[])
+    parser.add_argument('--excluded-region', help='Ignore the motion in this region, given as x0,y0,x1,y1 fractions of the image size. Can be repeated', type=parseRegion, action='append', default=[])
+    parser.add_argument('--days-max-size', help='Disk budget of the day videos, e.g. 20G. The oldest ones get removed first. Unlimited by default', type=retention.parseSize)
+    parser.add_argument('--days-max-age', help='Number of days to keep the day videos. Unlimited by default', type=float)
+    parser.add_argument('--alerts-max-size', help='Disk budget of the alerts, e.g. 20G. The oldest ones get removed first. Unlimited by default', type=retention.parseSize)
+    parser.add_argument('--alerts-max-age', help='Number of days to keep the alerts', type=float, default=30)
+    parser.add_argument('--recent-max-size', help='Disk budget of the latest images written for the web server. Unlimited by default', type=retention.parseSize)
+    parser.add_argument('--recent-max-age', help='Number of days to keep the latest images. Unlimited by default', type=float)
+    parser.add_argument('--queue-size', help='Maximum number of frames waiting in each processing stage', type=int, default=32)
+    parser.add_argument('--drop-policy', help='What to do when a processing stage is full. "block" slows down the reception', choices=pipeline.DROP_POLICIES, default='block')
+    parser.add_argument('--encoder-workers', help='Number of mp4 files that can be generated in parallel', type=int, default=2)
+    parser.add_argument('--processing-workers', help='Number of threads shared by the cameras for detection and archiving', type=int, default=4)
+
+def setupLogging(level):
+    logging.basicConfig(level=level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
 if __name__ == "__main__":
     args = parseCommandLine()
+    setupLogging(args.log_level)
+    metrics.prefix = 'watchdog'
+    if args.metrics_port:
+        metrics.startHttpServer(args.metrics_port)
 
     client = WatchDog(args)
-    client.reconnectToServer()
+    client.connectToServers()
     client.readImages()
@@ -1,99 +1,91 @@
 #!/usr/bin/env python3
 
 import os
-import re
+import hashlib
+import json
 import sys
+import threading
 from datetime import datetime, timedelta
 import argparse
 from pathlib import Path
-import json
 import math
+import urllib.request
 
 import flask
 from flask import Flask
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+import zmq
 
-def parseCommandLine():
-    parser = argparse.ArgumentParser(description='Tiny webserver to access the images')
-    parser.add_argument('--urlpath', help='Prefix to access the content. You can use this as security.', default="")
-    parser.add_argument('--data-dir', help='Directory where images and alerts are being written to', default='data')
-    return parser.parse_args()
+# alert_store.py is shared with the watchdog, one folder up.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import alert_store
+import thumbnails
+import wire_protocol
 
-print (sys.argv)
-
-args = parseCommandLine()
-
-# Make sure it's absolute path otherwise send_from_directory won't be happy.
-args.data_dir = os.path.abspath(args.data_dir)
-
-recent_buffer_dir = os.path.join(args.data_dir, 'tmp_recent_buffer')
-days_dir = os.path.join(args.data_dir, 'days')
-alerts_dir = Path(args.data_dir) / 'alerts'
-
-def parse_date(s):
-    m = re.match('(\d\d\d\d)-(\d\d)-(\d\d)_(\d\d)_(\d\d)_(\d\d)', s)
-    if not m:
-        return None
-    year = int(m.group(1))
-    month = int(m.group(2))
-    day = int(m.group(3))
-    hour = int(m.group(4))
-    minute = int(m.group(5))
-    second = int(m.group(6))
-    return datetime(year, month, day, hour, minute, second)
-
-def parse_recent_alerts():
-    alerts_db = alerts_dir / 'alerts.db'
-    with open(alerts_db, 'r') as f:
-        f.seek(0, os.SEEK_END)
-        file_pos = f.seek(max(0, f.tell() - 4096), os.SEEK_SET)
-        alerts = f.readlines()
-        # The first line might be cut if we did not read from file start,
-        # cut it.
-        if len(alerts) > 0 and file_pos > 0:
-            alerts = alerts[1:]
-        
-        alerts = reversed(alerts) # most recent first.
-        # Remove lines that do not finish with \n, might be because watchdog
-        # is still writing to it of because we started in the middle of a line.
-        alerts = filter(lambda l: l.endswith('\n'), alerts)        
-        print (alerts)
-    
-    alerts_per_day = {}
-    for l in alerts:
-        l = l.rstrip()
-        m = re.match('(\S+) (\S+) (\{.*\})$', l)
-        if not m:
-            continue
-        date = parse_date (m.group(1))
-        event = m.group(2)
-        json_content = m.group(3)
-        day = date.isocalendar()
-        if not day in alerts_per_day:
-            alerts_per_day[day] = []
-        alerts_per_day[day].append((date, event, json_content))
-        print (alerts_per_day)
-
-    days = sorted(alerts_per_day.items())
-    return (days, alerts_per_day)
-
-def compute_alerts_table_content():
-    alert_days, alerts_per_day = parse_recent_alerts()
-    now = datetime.now()
-    today = now.isocalendar()
-    yesterday = (now + timedelta(days=-1)).isocalendar()
+class AlertCache:
+    """Alerts of each day, kept until the alert store gets modified."""
+    def __init__(self, path):
+        self.path = path
+        self.store = None
+        self.version = None
+        self.alerts_per_day = {}
+        self.lock = threading.Lock()
+
+    def open_store(self):
+        # Created by the watchdog.
+        if self.store is None and os.path.exists(self.path):
+            self.store = alert_store.AlertStore(self.path, readOnly=True)
+        return self.store
+
+    def alerts_for_day(self, day):
+        with self.lock:
+            if self.open_store() is None:
+                return []
+            version = self.store.version()
+            if version != self.version:
+                self.alerts_per_day = {}
+                self.version = version
+            if day not in self.alerts_per_day:
+                start = datetime.combine(day, datetime.min.time())
+                self.alerts_per_day[day] = self.store.query(start, start + timedelta(days=1))
+            return self.alerts_per_day[day]
+
+    def current_version(self):
+        with self.lock:
+            return self.store.version() if self.open_store() else None
+
+# Suffix of the small rendition of the videos written by the watchdog.
+SMALL_VIDEO_SUFFIX = '_small'
+
+def prefers_small_videos(request):
+    """Small videos for phones and Save-Data clients, unless ?quality= says otherwise."""
+    quality = request.args.get('quality')
+    if quality in ('small', 'full'):
+        return quality == 'small'
+    if request.headers.get('Save-Data', '').lower() == 'on':
+        return True
+    return 'Mobi' in request.headers.get('User-Agent', '')
+
+def video_rendition(path, small):
+    if not small:
+        return path
+    return path[:-len('.mp4')] + SMALL_VIDEO_SUFFIX + '.mp4'
+
+def compute_alerts_table_content(alert_cache, today, small_videos):
+    yesterday = today - timedelta(days=1)
     daily_alerts_table_content = []
     for target_day in [yesterday, today]:
-        if target_day not in alerts_per_day:
+        alerts = alert_cache.alerts_for_day(target_day)
+        if not alerts:
             daily_alerts_table_content.append(None)
             continue
-        alerts = alerts_per_day[target_day]
         content = ""
         for alert in alerts:
-            folder_name = json.loads(alert[2])['folder_name']
-            html_folder_path = Path('data') / 'alerts' / folder_name
-            video_path = html_folder_path / 'before_and_after.mp4'
-            poster_path = html_folder_path / next((alerts_dir / folder_name).glob('*_annotated.jpg')).name
-            content += (f'<video width="480" poster="{poster_path}"'
+            video_path = Path('data') / 'alerts' / video_rendition(alert.video_path, small_videos)
+            # Only the thumbnail gets downloaded until the video is clicked.
+            poster = f' poster="{Path("data") / "thumbs" / "alerts" / alert.poster_path}"' if alert.poster_path else ''
+            content += (f'<video width="480" preload="none"{poster}'
                         + ' onplay="slowRate(this, 0.2)"'
                         # The goal here is to hide the controls initially so we can clearly see the annotated image
                         # This is especially important on iOS because the play button eats half of the image in the center..
@@ -103,53 +95,412 @@ def compute_alerts_table_content():
                         + ' onclick="this.controls = true; var self = this; setTimeout(function() { self.play(); }, 0); this.onclick=null;"'
                         + '>'
                         + f'<source src="{video_path}" type="video/mp4">Your browser does not support the video tag.</video>\n')
+            if alert.clip_path:
+                content += f'<a href="{Path("data") / "alerts" / alert.clip_path}">Full resolution clip</a>\n'
         daily_alerts_table_content.append(content)
     return daily_alerts_table_content
 
-app = Flask(__name__)
+def latest_image(recent_buffer_dir):
+    """File name of the most recent image, None if there is none yet."""
+    images = sorted(f for f in os.listdir(recent_buffer_dir) if f.endswith('.jpg'))
+    return images[-1] if images else None
+
+class MediaCatalog:
+    """Day videos, listed again only when the folder changes."""
+    def __init__(self, days_dir):
+        self.days_dir = days_dir
+        self.version = None
+        self.videos_per_day = []
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Returns the mtime of the folder, used as the catalog version."""
+        version = os.stat(self.days_dir).st_mtime_ns
+        with self.lock:
+            if version == self.version:
+                return version
+            fullVideos = []
+            partialVideos = []
+            for video in sorted(os.listdir(self.days_dir)):
+                if not video.endswith('.mp4') or video.endswith(SMALL_VIDEO_SUFFIX + '.mp4'):
+                    continue
+                if '_partial_' in video:
+                    partialVideos.append (video)
+                else:
+                    fullVideos.append (video)
+            videosPerDay = fullVideos
+            if len(partialVideos) > 0:
+                videosPerDay.append (partialVideos[-1])
+            self.videos_per_day = videosPerDay
+            self.version = version
+            return version
 
-# /static is delivered automatically.
+class StorageUsage:
+    """Disk usage per category, as last written by the retention of the watchdog."""
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+        self.usage = {}
+        self.lock = threading.Lock()
 
-@app.route('/' + args.urlpath)
-@app.route('/' + args.urlpath + '/')
-def index():
-    lastImages = sorted(os.listdir(recent_buffer_dir))
-    lastVideos_raw = sorted(os.listdir(days_dir))
-    fullVideos = []
-    partialVideos = []
-    for video in lastVideos_raw:
-        if not re.match('.*\.mp4$', video):
+    def refresh(self):
+        try:
+            version = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if version != self.version:
+                try:
+                    with open(self.path, 'r') as f:
+                        self.usage = json.load(f)
+                except (OSError, ValueError):
+                    self.usage = {}
+                self.version = version
+            return version
+
+    def page_version(self):
+        """Changes when the usage changes by at least a MB.
+
+        The size of the latest image changes with every frame, the page
+        should not.
+        """
+        with self.lock:
+            return tuple((category, u['bytes'] >> 20, u.get('max_bytes')) for category, u in sorted(self.usage.items()))
+
+def format_size(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            return f'{num_bytes:.0f} {unit}' if unit == 'B' else f'{num_bytes:.1f} {unit}'
+        num_bytes /= 1024.0
+    return f'{num_bytes:.1f} TB'
+
+def format_storage_usage(usage):
+    parts = []
+    for category, u in usage.items():
+        text = f'{category} {format_size(u["bytes"])}'
+        if u.get('max_bytes'):
+            text += f' / {format_size(u["max_bytes"])}'
+        parts.append(text)
+    return ', '.join(parts)
+
+class LiveStream:
+    """Latest frame of each camera, as published by the watchdog.
+
+    A single thread receives the frames and all the viewers share the
+    same bytes, nothing gets written to disk.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.frames = {} # camera_id -> (frame number, jpeg)
+        self.num_frames = 0
+        self.condition = threading.Condition()
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def receive(self):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        socket.setsockopt(zmq.RCVHWM, 2)
+        socket.connect(self.url)
+        socket.setsockopt(zmq.SUBSCRIBE, b'')
+        while True:
+            try:
+                header, jpeg = wire_protocol.receiveFrame(socket)
+            except wire_protocol.ProtocolError as e:
+                print (f"Ignoring invalid live frame: {e}")
+                continue
+            jpeg = jpeg.tobytes()
+            with self.condition:
+                self.num_frames += 1
+                self.frames[header.camera_id] = (self.num_frames, jpeg)
+                self.condition.notify_all()
+
+    def wait_for_frame(self, camera_id, last_frame_number, timeout):
+        """Returns (frame number, jpeg) of a frame newer than last_frame_number, or None."""
+        def has_new_frame():
+            return camera_id in self.frames and self.frames[camera_id][0] != last_frame_number
+        with self.condition:
+            if not self.condition.wait_for(has_new_frame, timeout):
+                return None
+            return self.frames[camera_id]
+
+# Finalized day videos and alert files never change once written. Partial
+# videos get replaced by the final one and the recent images get rotated.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+SHORT_MAX_AGE = 60
+
+# Stable name of the most recent image in the URLs.
+LATEST_IMAGE = 'latest.jpg'
+
+class CameraSite:
+    """Media of one camera, i.e. of one data directory of the watchdog."""
+    def __init__(self, name, data_dir, live_camera):
+        self.name = name
+        self.live_camera = live_camera
+        self.recent_buffer_dir = os.path.join(data_dir, 'tmp_recent_buffer')
+        self.days_dir = os.path.join(data_dir, 'days')
+        self.alerts_dir = os.path.join(data_dir, 'alerts')
+        self.alert_cache = AlertCache(os.path.join(self.alerts_dir, 'alerts.sqlite'))
+        self.media_catalog = MediaCatalog(self.days_dir)
+        self.storage_usage = StorageUsage(os.path.join(data_dir, 'storage_usage.json'))
+        # (ETag, rendered index page), with and without the small videos.
+        self.index_cache = {}
+
+def discover_cameras(data_dir):
+    """Returns a list of (name, data dir, live camera id).
+
+    Several cameras get a cameras/<name> folder each, see watchdog.py,
+    with a camera.json telling their position on its command line.
+    """
+    cameras_dir = os.path.join(data_dir, 'cameras')
+    if not os.path.isdir(cameras_dir):
+        return []
+    cameras = []
+    for i, name in enumerate(sorted(os.listdir(cameras_dir))):
+        camera_dir = os.path.join(cameras_dir, name)
+        if not os.path.isdir(camera_dir):
             continue
-        if re.match('.*_partial_.*\.mp4$', video):
-            partialVideos.append (video)
-        else:
-            fullVideos.append (video)        
-    videosPerDay = fullVideos
-    if len(partialVideos) > 0:
-        videosPerDay.append (partialVideos[-1])
-    videosPerDay = ['data/days/' + v for v in videosPerDay]
-
-    alerts = parse_recent_alerts()
-
-    daily_alerts_table_content = compute_alerts_table_content()
-
-    data = { 
-        'lastImage': 'data/recent/' + lastImages[-1],
-        'videosPerDay': videosPerDay,
-        'daily_alerts_table_content': daily_alerts_table_content,
-     }
-    return flask.render_template('index.html', title='Balandro - Overview', data=data)
-
-@app.route('/' + args.urlpath + '/data/recent/<path:path>')
-def send_image(path):
-    return flask.send_from_directory(recent_buffer_dir, path)
-
-@app.route('/' + args.urlpath + '/data/alerts/<path:path>')
-def send_alert_video(path):
-    return flask.send_from_directory(alerts_dir, path)
-
-@app.route('/' + args.urlpath + '/data/days/<path:path>')
-def send_days_video(path):
-    return flask.send_from_directory(days_dir, path)
-
-app.run(host="0.0.0.0", port=5555)
+        live_camera = i
+        try:
+            with open(os.path.join(camera_dir, 'camera.json'), 'r') as f:
+                live_camera = json.load(f)['live_camera']
+        except (OSError, ValueError, KeyError):
+            pass
+        cameras.append((name, camera_dir, live_camera))
+    return cameras
+
+def create_app(data_dir='data', urlpath='', live_url=None, live_camera=0, metrics_urls=(), use_x_sendfile=False,
+               thumbnail_cache_dir=None, thumbnail_cache_bytes=64*1024*1024):
+    """Returns the Flask application, can also be used by any WSGI server.
+
+    With several cameras, each one gets its pages under cameras/<name>/.
+
+    Example: gunicorn --chdir web_server 'web_server:create_app(data_dir="/data", urlpath="secret")'
+    """
+    # Make sure it's absolute path otherwise send_from_directory won't be happy.
+    data_dir = os.path.abspath(data_dir)
+    cameras = discover_cameras(data_dir)
+    if cameras:
+        sites = {name: CameraSite(name, camera_dir, camera_live) for name, camera_dir, camera_live in cameras}
+    else:
+        sites = {None: CameraSite(None, data_dir, live_camera)}
+    camera_names = [name for name, _, _ in cameras]
+
+    thumbnail_cache = thumbnails.ThumbnailCache(thumbnail_cache_dir or os.path.join(data_dir, 'thumbnail_cache'), thumbnail_cache_bytes)
+    live_stream = LiveStream(live_url) if live_url else None
+
+    app = Flask(__name__)
+    # Let a front-end server like Apache or lighttpd send the media files.
+    app.config['USE_X_SENDFILE'] = use_x_sendfile
+    prefix = '/' + urlpath
+    site_prefix = prefix + '/cameras/<camera>' if cameras else prefix
+
+    def get_site(camera):
+        if camera not in sites:
+            flask.abort(404)
+        return sites[camera]
+
+    def route(rule):
+        return app.route(site_prefix + rule)
+
+    # /static is delivered automatically.
+
+    @route('/')
+    def index(camera=None):
+        site = get_site(camera)
+        catalog_version = site.media_catalog.refresh()
+        today = datetime.now().date()
+        small_videos = prefers_small_videos(flask.request)
+        site.storage_usage.refresh()
+        usage_version = site.storage_usage.page_version()
+        etag = hashlib.sha1(repr((catalog_version, site.alert_cache.current_version(), usage_version, today, small_videos)).encode()).hexdigest()
+
+        if small_videos not in site.index_cache or site.index_cache[small_videos][0] != etag:
+            data = {
+                # Stable URLs, so the page does not change with every new image.
+                'lastImage': 'data/recent/' + LATEST_IMAGE,
+                'lastThumbnail': 'data/thumbs/recent/' + LATEST_IMAGE,
+                'liveImage': f'live/{site.live_camera}' if live_stream else None,
+                'videosPerDay': ['data/days/' + video_rendition(v, small_videos) for v in site.media_catalog.videos_per_day],
+                'daily_alerts_table_content': compute_alerts_table_content(site.alert_cache, today, small_videos),
+                'storageUsage': format_storage_usage(site.storage_usage.usage),
+                # Relative to cameras/<name>/.
+                'cameras': [(name, f'../{name}/') for name in camera_names],
+                'camera': camera,
+            }
+            title = f'Balandro - {camera}' if camera else 'Balandro - Overview'
+            site.index_cache[small_videos] = (etag, flask.render_template('index.html', title=title, data=data))
+
+        response = flask.make_response(site.index_cache[small_videos][1])
+        response.set_etag(etag)
+        response.vary.update(['User-Agent', 'Save-Data'])
+        response.last_modified = datetime.fromtimestamp(catalog_version / 1e9)
+        # Let the clients cache it, but check for changes on every poll.
+        response.cache_control.no_cache = True
+        return response.make_conditional(flask.request)
+
+    if cameras:
+        @app.route(prefix)
+        @app.route(prefix + '/')
+        def cameras_index():
+            return flask.redirect(f'{prefix.rstrip("/")}/cameras/{camera_names[0]}/')
+    else:
+        app.add_url_rule(prefix, 'root_index', index)
+
+    # send_from_directory handles If-None-Match, If-Modified-Since and Range
+    # requests, which the browsers need to seek in the videos. Complete files
+    # go through the wsgi.file_wrapper of the server, e.g. sendfile with
+    # gunicorn, so no worker has to copy them.
+    @route('/data/recent/<path:path>')
+    def send_image(path, camera=None):
+        return flask.send_from_directory(get_site(camera).recent_buffer_dir, path, max_age=SHORT_MAX_AGE)
+
+    def send_latest(recent_buffer_dir, send):
+        # The watchdog replaces the image every frame, it can be gone by
+        # the time it gets opened.
+        for attempt in range(2):
+            name = latest_image(recent_buffer_dir)
+            if name is None:
+                flask.abort(404)
+            try:
+                response = send(name)
+            except NotFound:
+                continue
+            # The clients revalidate it with its ETag on every poll.
+            response.cache_control.max_age = None
+            response.cache_control.public = False
+            response.cache_control.no_cache = True
+            return response
+        flask.abort(404)
+
+    @route('/data/recent/' + LATEST_IMAGE)
+    def send_latest_image(camera=None):
+        recent_buffer_dir = get_site(camera).recent_buffer_dir
+        return send_latest(recent_buffer_dir, lambda name: flask.send_from_directory(recent_buffer_dir, name))
+
+    @route('/data/thumbs/recent/' + LATEST_IMAGE)
+    def send_latest_thumbnail(camera=None):
+        recent_buffer_dir = get_site(camera).recent_buffer_dir
+        return send_latest(recent_buffer_dir, lambda name: send_thumbnail(recent_buffer_dir, name))
+
+    def send_thumbnail(directory, path):
+        # The file names of the images are unique, their thumbnails never change.
+        source_path = safe_join(directory, path)
+        if source_path is None:
+            flask.abort(404)
+        written_path = thumbnails.thumbnailPath(source_path)
+        if os.path.exists(written_path):
+            return flask.send_file(written_path, max_age=IMMUTABLE_MAX_AGE)
+        # Images saved before the thumbnails, and the recent images.
+        cached_path = thumbnail_cache.get(source_path)
+        if cached_path is None:
+            raise NotFound()
+        return flask.send_file(cached_path, mimetype='image/jpeg', max_age=IMMUTABLE_MAX_AGE)
+
+    @route('/data/thumbs/recent/<path:path>')
+    def send_recent_thumbnail(path, camera=None):
+        return send_thumbnail(get_site(camera).recent_buffer_dir, path)
+
+    @route('/data/thumbs/alerts/<path:path>')
+    def send_alert_thumbnail(path, camera=None):
+        return send_thumbnail(get_site(camera).alerts_dir, path)
+
+    def send_video(directory, path, max_age):
+        small_suffix = SMALL_VIDEO_SUFFIX + '.mp4'
+        if path.endswith(small_suffix):
+            full_path = safe_join(directory, path)
+            if full_path is None or not os.path.exists(full_path):
+                # Videos written by older versions only have the full rendition.
+                path = path[:-len(small_suffix)] + '.mp4'
+        return flask.send_from_directory(directory, path, max_age=max_age)
+
+    @route('/data/alerts/<path:path>')
+    def send_alert_video(path, camera=None):
+        return send_video(get_site(camera).alerts_dir, path, IMMUTABLE_MAX_AGE)
+
+    @route('/data/days/<path:path>')
+    def send_days_video(path, camera=None):
+        max_age = SHORT_MAX_AGE if '_partial_' in path else IMMUTABLE_MAX_AGE
+        return send_video(get_site(camera).days_dir, path, max_age)
+
+    @app.route(prefix + '/live')
+    @app.route(prefix + '/live/<int:camera_id>')
+    def live(camera_id=0):
+        """MJPEG stream of the latest frames, browsers can show it in an img tag."""
+        if not live_stream:
+            flask.abort(404)
+        def generate():
+            last_frame_number = None
+            jpeg = None
+            while True:
+                frame = live_stream.wait_for_frame(camera_id, last_frame_number, timeout=10)
+                if frame is not None:
+                    last_frame_number, jpeg = frame
+                elif jpeg is None:
+                    # Nothing received yet, the watchdog is probably down.
+                    # Ending the response frees the request thread.
+                    return
+                # On timeout the last frame gets sent again, the write is
+                # what tells the server that the client disconnected.
+                # Yield the shared jpeg as is instead of a concatenated copy.
+                yield b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(jpeg)
+                yield jpeg
+                yield b'\r\n'
+        response = flask.Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+        response.cache_control.no_store = True
+        return response
+
+    if cameras:
+        # The pages of the cameras link to live/<id> relative to their folder.
+        @route('/live/<int:camera_id>')
+        def camera_live(camera_id, camera=None):
+            get_site(camera)
+            return live(camera_id)
+
+    @app.route(prefix + '/metrics')
+    def metrics():
+        if not metrics_urls:
+            flask.abort(404)
+        content = ""
+        for url in metrics_urls:
+            try:
+                with urllib.request.urlopen(url, timeout=5) as response:
+                    content += response.read().decode('utf-8')
+            except OSError as e:
+                content += f"# Could not fetch {url}: {e}\n"
+        return flask.Response(content, mimetype='text/plain')
+
+    return app
+
+def parseCommandLine():
+    parser = argparse.ArgumentParser(description='Tiny webserver to access the images')
+    parser.add_argument('--urlpath', help='Prefix to access the content. You can use this as security.', default="")
+    parser.add_argument('--data-dir', help='Directory where images and alerts are being written to, i.e. the --data-dir of watchdog.py. '
+                        'All its cameras are served', default='data')
+    parser.add_argument('--host', help='Address to listen on', default='0.0.0.0')
+    parser.add_argument('--port', help='Port to listen on', type=int, default=5555)
+    parser.add_argument('--threads', help='Number of request threads. Each live view keeps one busy', type=int, default=16)
+    parser.add_argument('--use-x-sendfile', help='Let the front-end server send the media files with X-Sendfile', action='store_true')
+    parser.add_argument('--live-url', help='zmq address given to watchdog.py --live-publish-url, enables the live view')
+    parser.add_argument('--live-camera', help='Camera shown by the live view of the index page with a single camera, in the order given to watchdog.py', type=int, default=0)
+    parser.add_argument('--thumbnail-cache-dir', help='Where to keep the thumbnails generated on demand, default is DATA_DIR/thumbnail_cache')
+    parser.add_argument('--thumbnail-cache-mb', help='Maximum size of the thumbnail cache, in MB', type=int, default=64)
+    parser.add_argument('--metrics-url', help='Prometheus metrics URL of the watchdog or image server, shown on the metrics page. Can be repeated', action='append', default=[])
+    return parser.parse_args()
+
+def main():
+    print (sys.argv)
+    args = parseCommandLine()
+    app = create_app(data_dir=args.data_dir, urlpath=args.urlpath, live_url=args.live_url, live_camera=args.live_camera,
+                     metrics_urls=args.metrics_url, use_x_sendfile=args.use_x_sendfile,
+                     thumbnail_cache_dir=args.thumbnail_cache_dir, thumbnail_cache_bytes=args.thumbnail_cache_mb*1024*1024)
+    try:
+        import waitress
+    except ImportError:
+        print ("waitress is not installed, falling back to the Flask development server")
+        app.run(host=args.host, port=args.port, threaded=True)
+        return
+    # The files sent through wsgi.file_wrapper are streamed by the main
+    # loop of waitress, slow clients do not hold a request thread.
+    waitress.serve(app, host=args.host, port=args.port, threads=args.threads)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Messages sent from the image server to the watchdog.
+#
+# Each frame is a 2-part zmq message: a fixed-size header and the raw
+# encoded image. The payload is sent and received without copies and
+# nothing gets unpickled on the receiving side.
+#
+# Older image servers used to send each JPEG with send_pyobj, this is
+# still accepted when explicitly allowed.
+#
+# The watchdog can also send control requests to the image server, on a
+# separate channel from a DEALER socket to a ROUTER socket. Clips of the
+# original camera stream are requested and sent back on a third channel,
+# so a large upload never delays the frames or the control requests.
+
+import pickle
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = b'TW'
+VERSION = 1
+
+ENCODING_JPEG = 1
+
+# magic, version, encoding, camera id, width, height, sequence number,
+# capture timestamp (seconds since the epoch).
+HEADER = struct.Struct('<2sBBHHHQd')
+
+FrameHeader = namedtuple('FrameHeader', 'camera_id sequence timestamp width height encoding')
+
+# Send at the active frame rate and resolution for the given duration.
+COMMAND_ACTIVE = 1
+
+# magic, version, command, duration in seconds.
+CONTROL = struct.Struct('<2sBBd')
+
+ControlRequest = namedtuple('ControlRequest', 'command seconds')
+
+ENCODING_MPEGTS = 2
+
+# magic, version, request id, seconds before and after the request.
+CLIP_REQUEST = struct.Struct('<2sBIdd')
+# magic, version, encoding, request id, start and end time of the clip
+# (seconds since the epoch).
+CLIP_HEADER = struct.Struct('<2sBBIdd')
+
+ClipRequest = namedtuple('ClipRequest', 'request_id seconds_before seconds_after')
+ClipHeader = namedtuple('ClipHeader', 'request_id start_time end_time encoding')
+
+class ProtocolError(Exception):
+    pass
+
+def packHeader(header):
+    return HEADER.pack(MAGIC, VERSION, header.encoding, header.camera_id,
+                       header.width, header.height, header.sequence, header.timestamp)
+
+def unpackHeader(buffer):
+    if len(buffer) != HEADER.size:
+        raise ProtocolError(f"Invalid header size {len(buffer)}")
+    magic, version, encoding, camera_id, width, height, sequence, timestamp = HEADER.unpack(buffer)
+    if magic != MAGIC:
+        raise ProtocolError("Invalid magic number")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    return FrameHeader(camera_id=camera_id, sequence=sequence, timestamp=timestamp,
+                       width=width, height=height, encoding=encoding)
+
+def sendFrame(socket, header, payload):
+    socket.send_multipart([packHeader(header), payload], copy=False)
+
+def receiveFrame(socket, acceptPickle=False):
+    """Returns (header, payload), the header is None for legacy messages.
+
+    The payload is a uint8 array pointing to the zmq message buffer.
+    """
+    parts = socket.recv_multipart(copy=False)
+    if len(parts) == 1:
+        if not acceptPickle:
+            raise ProtocolError("Received a legacy pickled message, use --legacy-pickle-protocol to accept it")
+        return None, pickle.loads(parts[0].bytes)
+    if len(parts) != 2:
+        raise ProtocolError(f"Unexpected number of message parts: {len(parts)}")
+    header = unpackHeader(parts[0].buffer)
+    payload = np.frombuffer(parts[1].buffer, dtype=np.uint8)
+    return header, payload
+
+def sendControlRequest(socket, request, flags=0):
+    socket.send(CONTROL.pack(MAGIC, VERSION, request.command, request.seconds), flags)
+
+def receiveControlRequest(socket):
+    """Receives a request on a ROUTER socket."""
+    parts = socket.recv_multipart()
+    if len(parts) != 2 or len(parts[1]) != CONTROL.size:
+        raise ProtocolError("Invalid control request")
+    magic, version, command, seconds = CONTROL.unpack(parts[1])
+    checkMagicAndVersion(magic, version)
+    return ControlRequest(command=command, seconds=seconds)
+
+def checkMagicAndVersion(magic, version):
+    if magic != MAGIC:
+        raise ProtocolError("Invalid magic number")
+    if version != VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+
+def sendClipRequest(socket, request, flags=0):
+    socket.send(CLIP_REQUEST.pack(MAGIC, VERSION, request.request_id, request.seconds_before, request.seconds_after), flags)
+
+def receiveClipRequest(socket):
+    """Receives a request on a ROUTER socket, returns (identity, request)."""
+    parts = socket.recv_multipart()
+    if len(parts) != 2 or len(parts[1]) != CLIP_REQUEST.size:
+        raise ProtocolError("Invalid clip request")
+    magic, version, request_id, seconds_before, seconds_after = CLIP_REQUEST.unpack(parts[1])
+    checkMagicAndVersion(magic, version)
+    return parts[0], ClipRequest(request_id=request_id, seconds_before=seconds_before, seconds_after=seconds_after)
+
+def sendClip(socket, identity, header, payload):
+    packedHeader = CLIP_HEADER.pack(MAGIC, VERSION, header.encoding, header.request_id, header.start_time, header.end_time)
+    socket.send_multipart([identity, packedHeader, payload], copy=False)
+
+def receiveClip(socket):
+    """Returns (header, payload) of a clip received on a DEALER socket."""
+    parts = socket.recv_multipart(copy=False)
+    if len(parts) != 2 or len(parts[0].buffer) != CLIP_HEADER.size:
+        raise ProtocolError("Invalid clip message")
+    magic, version, encoding, request_id, start_time, end_time = CLIP_HEADER.unpack(parts[0].buffer)
+    checkMagicAndVersion(magic, version)
+    header = ClipHeader(request_id=request_id, start_time=start_time, end_time=end_time, encoding=encoding)
+    return header, parts[1].buffer